@@ -0,0 +1,216 @@
+# A synthetic load of many users going through the whole bot: login, adding a
+# reminder, /timbra, /entra, removing the reminder and /esci. Every user sends
+# the next update as soon as the bot answered the previous one (plus an
+# optional think time), through the real Dispatcher and handlers:
+#
+#     python -m benchmarks.load --users 2000 --think 0.5
+#
+# It reports the updates per second, the step latency, the busy time of the
+# dispatcher and of the portal workers and the writes of the persistence.
+
+import argparse
+import logging
+import os
+import random
+import threading
+import time
+
+from merdetti import notifications
+from merdetti.executor import PORTAL_WORKERS, portal_executor
+from merdetti.helpers import CALLBACK_SESSION
+from merdetti.metrics import HANDLER_SECONDS
+from merdetti.scheduler import DelayedRunner
+
+from .portal import PASSWORD
+from .scenarios import Harness, new_user_ids, percentile
+
+SAMPLE_INTERVAL = 0.1
+RETRY_DELAY = 1
+# the bot answers so when the portal executor is full
+OVERLOADED = "sovraccarico"
+
+# (kind, payload, calls to the chat that complete the step)
+JOURNEY = [
+    ("command", "/login", 1),
+    ("text", "{username} " + PASSWORD, 2),
+    ("command", "/notifiche", 1),
+    ("callback", notifications.NOTIFICATION_ADD_CALLBACK, 1),
+    ("callback", notifications.REMIND_ENTER_CALLBACK, 1),
+    ("callback", notifications.DAYS_OF_WEEK[4], 1),
+    ("callback", notifications.CHOOSE_TIME_CALLBACK, 1),
+    ("text", "{time}", 1),
+    ("command", "/timbra", 2),
+    ("command", "/entra", 2),
+    ("command", "/notifiche", 1),
+    ("callback", notifications.NOTIFICATION_REMOVE_CALLBACK, 1),
+    ("text", "1", 1),
+    ("command", "/esci", 2),
+]
+
+logger = logging.getLogger(__name__)
+
+
+def handler_seconds() -> float:
+    return sum(
+        sample.value
+        for metric in HANDLER_SECONDS.collect()
+        for sample in metric.samples
+        if sample.name.endswith("_sum")
+    )
+
+
+class Load:
+    def __init__(self, harness: Harness, user_ids: list, think: float) -> None:
+        self.harness = harness
+        self.think = think
+
+        self._steps = {user_id: 0 for user_id in user_ids}
+        self._calls = {user_id: 0 for user_id in user_ids}
+        self._sent_at = dict()
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._remaining = len(user_ids)
+        self._runner = DelayedRunner()
+
+        self.latencies = []
+        self.updates = 0
+        self.rejected = 0
+
+        harness.telegram.listeners.append(self._on_call)
+
+    def start(self) -> None:
+        for user_id in self._steps:
+            self._send(user_id)
+
+    @property
+    def remaining(self) -> int:
+        return self._remaining
+
+    def stuck(self) -> dict:
+        # how many users did not get an answer at each step of the journey
+        with self._lock:
+            steps = [s for s in self._steps.values() if s < len(JOURNEY)]
+
+        return {JOURNEY[s][1]: steps.count(s) for s in sorted(set(steps))}
+
+    def wait(self, timeout: float) -> bool:
+        return self._done.wait(timeout)
+
+    def _send(self, user_id: int) -> None:
+        kind, payload, _ = JOURNEY[self._steps[user_id]]
+        payload = payload.format(
+            username=f"user{user_id}",
+            time=f"{random.randrange(7, 10):02d}:{random.randrange(60):02d}",
+        )
+
+        with self._lock:
+            self._sent_at[user_id] = time.monotonic()
+            self.updates += 1
+
+        if kind == "command":
+            self.harness.command(user_id, payload)
+        elif kind == "text":
+            self.harness.message(user_id, payload)
+        else:
+            # the user presses a button of the last keyboard received
+            session = self.harness.dispatcher.user_data[user_id].get(CALLBACK_SESSION)
+            self.harness.callback(user_id, f"{payload}#{session}")
+
+    def _on_call(self, method: str, chat_id, text: str) -> None:
+        if chat_id not in self._steps or method == "answerCallbackQuery":
+            return
+
+        with self._lock:
+            self._calls[chat_id] += 1
+            step = self._steps[chat_id]
+
+            if text and OVERLOADED in text:
+                # like a user, try again a bit later
+                self.rejected += 1
+                self._calls[chat_id] = 0
+                self._runner.run_later(RETRY_DELAY, self._send, chat_id)
+                return
+
+            if self._calls[chat_id] < JOURNEY[step][2]:
+                return
+
+            self.latencies.append(time.monotonic() - self._sent_at[chat_id])
+            self._calls[chat_id] = 0
+            self._steps[chat_id] = step + 1
+
+            if step + 1 == len(JOURNEY):
+                self._remaining -= 1
+                if not self._remaining:
+                    self._done.set()
+                return
+
+        self._runner.run_later(random.uniform(0, 2 * self.think), self._send, chat_id)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--think", type=float, default=0, help="mean think time")
+    parser.add_argument("--portal-latency", type=float, default=0.1)
+    parser.add_argument("--portal-errors", type=float, default=0)
+    parser.add_argument("--portal-expire", type=float, default=0)
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--verbose", action="store_true")
+    options = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO if options.verbose else logging.ERROR,
+    )
+
+    harness = Harness(options)
+    # the credentials sent by the users are verified against the mock portal
+    os.environ["ZUCCHETTI_BASE_URL"] = harness.portal.url
+
+    load = Load(harness, new_user_ids(options.users), options.think)
+    stats_before = harness.persistence.stats
+    busy_before = handler_seconds()
+    portal_busy = []
+
+    started = time.monotonic()
+    load.start()
+    while not load.wait(SAMPLE_INTERVAL):
+        portal_busy.append(min(portal_executor.pending, PORTAL_WORKERS))
+        if time.monotonic() - started > options.timeout:
+            break
+    elapsed = time.monotonic() - started
+
+    harness.close()
+    stats = harness.persistence.stats
+
+    print(
+        f"{options.users - load.remaining}/{options.users} users completed, "
+        f"{load.updates} updates in {elapsed:.1f}s, "
+        f"{load.rejected} rejected as overloaded"
+    )
+    print(
+        f"  throughput: {load.updates / elapsed:.1f} updates/s, step latency "
+        f"p50 {percentile(load.latencies, 50):.3f}s, "
+        f"p99 {percentile(load.latencies, 99):.3f}s"
+    )
+    # the share of the time the workers of each pool spent busy
+    dispatcher_busy = (handler_seconds() - busy_before) / elapsed / options.workers
+    print(
+        f"  utilization: dispatcher workers {dispatcher_busy:.0%}, "
+        f"portal workers {sum(portal_busy) / max(len(portal_busy), 1) / PORTAL_WORKERS:.0%}"
+    )
+    print(
+        f"  persistence: {stats['writes'] - stats_before['writes']} writes, "
+        f"{stats['writes_avoided'] - stats_before['writes_avoided']} avoided, "
+        f"{stats['rows_flushed'] - stats_before['rows_flushed']} rows in "
+        f"{stats['flushes'] - stats_before['flushes']} flushes"
+    )
+    print(f"  portal: {dict(harness.portal.requests)}")
+    if load.remaining:
+        print(f"  stuck at: {load.stuck()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+# A local stand-in of the Zucchetti portal, with the endpoints used by
+# merdetti.zucchetti and a configurable latency, error rate and rate of expired
+# sessions.
+
+import json
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from merdetti.zucchetti import (
+    LOGIN_PATH,
+    M_CID_PATH,
+    SQL_DATA_PROVIDER_PATH,
+    STAMP_PATH,
+)
+
+PASSWORD = "password"
+M_CID = "0123456789abcdef"
+# the m_cID of the real page is near the top of ~200KB of markup
+M_CID_PAGE = (
+    f"<html><script>this.splinker10.m_cID='{M_CID}';</script>" + "x" * 200000
+).encode()
+
+
+class PortalHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        portal = self.server.portal
+        length = int(self.headers.get("Content-Length") or 0)
+        form = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+        path = urlparse(self.path).path
+
+        portal.count(path)
+        if portal.latency:
+            time.sleep(portal.latency * random.uniform(0.5, 1.5))
+
+        if path == LOGIN_PATH:
+            self._login(form)
+            return
+
+        username = portal.sessions.get(self._session_id())
+        if username is None or random.random() < portal.expire_rate:
+            # like the portal, an expired session is sent to the login page
+            self._reply(b"", status=302, headers={"Location": LOGIN_PATH})
+            return
+
+        if random.random() < portal.error_rate:
+            self._reply(b"error", status=500)
+            return
+
+        if path == SQL_DATA_PROVIDER_PATH:
+            self._json(
+                portal.stamps_result(
+                    username,
+                    form.get("pDATE"),
+                    int(form.get("startrow") or 0),
+                    int(form.get("rows") or 10),
+                )
+            )
+        elif path == urlparse(M_CID_PATH).path:
+            self._reply(M_CID_PAGE, content_type="text/html")
+        elif path == STAMP_PATH:
+            if form.get("m_cID") != M_CID:
+                self._reply(b"errore")
+            else:
+                portal.stamp(username, form.get("verso"))
+                self._reply(b"routine eseguita")
+        else:
+            self._reply(b"not found", status=404)
+
+    def _login(self, form):
+        if self.command == "GET":
+            self._reply(b"<html>login</html>", content_type="text/html")
+            return
+
+        if form.get("m_cPassword") != PASSWORD:
+            self._reply(b"", headers={"JSURL-Message": "utente non riconosciuto"})
+            return
+
+        session_id = uuid.uuid4().hex
+        self.server.portal.sessions[session_id] = form.get("m_cUserName")
+        self._reply(b"ok", headers={"Set-Cookie": f"JSESSIONID={session_id}; Path=/"})
+
+    def _session_id(self):
+        for cookie in (self.headers.get("Cookie") or "").split(";"):
+            name, _, value = cookie.strip().partition("=")
+            if name == "JSESSIONID":
+                return value
+
+    def _json(self, result):
+        self._reply(json.dumps(result).encode(), content_type="application/json")
+
+    def _reply(self, body: bytes, status=200, headers=None, content_type="text/plain"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PortalServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # the client stops reading the m_cID page as soon as the token is found
+        pass
+
+
+class MockPortal:
+    def __init__(
+        self,
+        latency: float = 0.05,
+        error_rate: float = 0,
+        expire_rate: float = 0,
+        port: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.expire_rate = expire_rate
+        self.sessions = dict()
+        self.requests = defaultdict(int)
+
+        self._stamps = defaultdict(list)
+        self._lock = threading.Lock()
+        self._server = PortalServer(("127.0.0.1", port), PortalHandler)
+        self._server.portal = self
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self) -> "MockPortal":
+        threading.Thread(
+            target=self._server.serve_forever, name="mock_portal", daemon=True
+        ).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self, path: str) -> None:
+        with self._lock:
+            self.requests[path] += 1
+
+    def stamp(self, username: str, direction: str) -> None:
+        now = datetime.now()
+        with self._lock:
+            self._stamps[(username, f"{now:%Y-%m-%d}")].append(
+                ["", f"{now:%H:%M}", direction]
+            )
+
+    def stamps_result(self, username: str, day: str, startrow=0, rows=10) -> dict:
+        with self._lock:
+            stamps = list(self._stamps[(username, day)])
+
+        # the last element of Data is the count of the whole query
+        page = stamps[startrow : startrow + rows]
+        return {"Data": page + [[str(len(stamps)), "", ""]]}
@@ -0,0 +1,87 @@
+# Compares the dict router with the previous chain of regex handlers:
+#
+#     python -m benchmarks.routing [iterations]
+
+import sys
+import timeit
+
+from telegram import Update
+from telegram.ext import CallbackQueryHandler
+
+from merdetti import bot, notifications
+from merdetti.helpers import split_callback_data
+
+SESSION = "6f1c2a9e-1b7d-4f4e-9a43-5d2c8e0b7a11"
+
+
+def legacy_handlers() -> list:
+    def pattern(key):
+        return "^" + key + r"#[\w-]+$"
+
+    days = "|".join(
+        [notifications.REMIND_ENTER_CALLBACK, notifications.REMIND_EXIT_CALLBACK]
+        + list(notifications.DAYS_OF_WEEK.values())
+    )
+    actions = [
+        bot.LOGIN_CALLBACK,
+        bot.CANCEL_CALLBACK,
+        bot.ENTER_CALLBACK,
+        bot.EXIT_CALLBACK,
+        notifications.NOTIFICATION_EXIT_CALLBACK,
+        notifications.NOTIFICATION_BACK_CALLBACK,
+        notifications.NOTIFICATION_REMOVE_CALLBACK,
+        notifications.NOTIFICATION_ADD_CALLBACK,
+        f"({days})",
+        notifications.CHOOSE_TIME_CALLBACK,
+    ]
+
+    return [CallbackQueryHandler(print, pattern=pattern(a)) for a in actions]
+
+
+def callback_update(action: str) -> Update:
+    return Update.de_json(
+        {
+            "update_id": 1,
+            "callback_query": {
+                "id": "1",
+                "from": {"id": 1, "is_bot": False, "first_name": "bench"},
+                "chat_instance": "1",
+                "data": f"{action}#{SESSION}",
+            },
+        },
+        None,
+    )
+
+
+def run(iterations: int) -> None:
+    handlers = legacy_handlers()
+    router = bot.make_router()
+    routes = router._callbacks
+
+    def legacy(update):
+        for handler in handlers:
+            if handler.check_update(update):
+                return handler
+
+    # every keyboard has a fresh session, so skip the cache of the split
+    split = split_callback_data.__wrapped__
+
+    def routed(update):
+        action, _ = split(update.callback_query.data)
+        return routes.get(action)
+
+    # the first action is matched by the first handler, the last day by the last
+    for action in (bot.LOGIN_CALLBACK, notifications.CHOOSE_TIME_CALLBACK, "domenica"):
+        update = callback_update(action)
+        legacy_seconds = timeit.timeit(lambda: legacy(update), number=iterations)
+        routed_seconds = timeit.timeit(lambda: routed(update), number=iterations)
+
+        print(
+            f"{action:>22}: regex chain {legacy_seconds / iterations * 1e6:7.2f}us, "
+            f"router {routed_seconds / iterations * 1e6:7.2f}us "
+            f"({legacy_seconds / routed_seconds:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
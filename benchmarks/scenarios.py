@@ -0,0 +1,294 @@
+# End-to-end scenarios that drive the handlers of merdetti.bot through a real
+# Dispatcher, against the mock portal and the fake Telegram API:
+#
+#     python -m benchmarks.scenarios [timbra entra reminders broadcast] \
+#         --users 200 --portal-latency 0.2 --portal-errors 0.01
+#
+# Every scenario reports the throughput, the latency percentiles from the
+# first update to the reply of each user and the peak of traced memory.
+
+import argparse
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+from telegram import Bot, Update
+from telegram.utils.request import Request
+
+from merdetti import bot
+from merdetti.constants import LOGGED
+from merdetti.scheduler import ReminderScheduler
+from merdetti.zucchetti import ZucchettiApi
+
+from .portal import PASSWORD, MockPortal
+from .telegram import FakeTelegram
+
+ADMIN_ID = 1000
+
+logger = logging.getLogger(__name__)
+
+# users are never shared between scenarios, so neither are their cached stamps
+_user_ids = itertools.count(ADMIN_ID + 1)
+_update_ids = itertools.count(1)
+
+
+def new_user_ids(count: int) -> list:
+    return [next(_user_ids) for _ in range(count)]
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return float("nan")
+
+    values = sorted(values)
+    return values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))]
+
+
+class Harness:
+    def __init__(self, options) -> None:
+        self.options = options
+        self.portal = MockPortal(
+            latency=options.portal_latency,
+            error_rate=options.portal_errors,
+            expire_rate=options.portal_expire,
+        ).start()
+        self.telegram = FakeTelegram(latency=options.telegram_latency).start()
+
+        self.data_dir = tempfile.mkdtemp(prefix="merdetti-bench-")
+        self.persistence = bot.make_persistence(self.data_dir)
+        self.updater = bot.make_updater(
+            Bot(
+                "123456:benchmark",
+                base_url=self.telegram.base_url,
+                request=Request(con_pool_size=bot.telegram_pool_size(options.workers)),
+            ),
+            self.persistence,
+            options.workers,
+        )
+        self.dispatcher = self.updater.dispatcher
+
+        for handler in bot.handlers():
+            self.dispatcher.add_handler(handler)
+
+        self.updater.job_queue.start()
+        threading.Thread(
+            target=self.dispatcher.start, name="dispatcher", daemon=True
+        ).start()
+
+    def add_users(self, count: int) -> list:
+        user_ids = new_user_ids(count)
+        for user_id in user_ids:
+            bot.zucchetti_users[user_id] = ZucchettiApi(
+                f"user{user_id}", PASSWORD, base_url=self.portal.url
+            )
+            self.dispatcher.user_data[user_id][LOGGED] = True
+            self.persistence.update_user_data(
+                user_id, self.dispatcher.user_data[user_id]
+            )
+
+        return user_ids
+
+    def command(self, user_id: int, text: str) -> None:
+        command = text.split()[0]
+        self.message(
+            user_id,
+            text,
+            entities=[{"type": "bot_command", "offset": 0, "length": len(command)}],
+        )
+
+    def message(self, user_id: int, text: str, entities=()) -> None:
+        self._put(
+            {
+                "update_id": next(_update_ids),
+                "message": dict(
+                    self._message(user_id), text=text, entities=list(entities)
+                ),
+            }
+        )
+
+    def callback(self, user_id: int, data: str) -> None:
+        self._put(
+            {
+                "update_id": next(_update_ids),
+                "callback_query": {
+                    "id": str(next(_update_ids)),
+                    "from": self._message(user_id)["from"],
+                    "chat_instance": str(user_id),
+                    "message": dict(self._message(user_id), text="menu"),
+                    "data": data,
+                },
+            }
+        )
+
+    def _message(self, user_id: int) -> dict:
+        return {
+            "message_id": next(_update_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"{user_id}"},
+        }
+
+    def _put(self, update: dict) -> None:
+        self.updater.update_queue.put(Update.de_json(update, self.updater.bot))
+
+    def close(self) -> None:
+        self.dispatcher.stop()
+        self.updater.job_queue.stop()
+        self.persistence.flush()
+        self.portal.stop()
+        self.telegram.stop()
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+
+def timbra(harness: Harness, options):
+    user_ids = harness.add_users(options.users)
+
+    started = time.monotonic()
+    for user_id in user_ids:
+        harness.command(user_id, "/timbra")
+
+    # the working message is edited with the status of the card
+    return started, harness.telegram.wait(
+        "editMessageText", user_ids, timeout=options.timeout
+    )
+
+
+def entra(harness: Harness, options):
+    user_ids = harness.add_users(options.users)
+
+    started = time.monotonic()
+    for _ in range(options.repeat):
+        for user_id in user_ids:
+            harness.command(user_id, "/entra")
+
+    return started, harness.telegram.wait(
+        "editMessageText", user_ids, count=options.repeat, timeout=options.timeout
+    )
+
+
+def reminders(harness: Harness, options):
+    user_ids = harness.add_users(options.users)
+
+    now = datetime.now()
+    scheduler = ReminderScheduler(jitter=options.jitter)
+    for user_id in user_ids:
+        schedule_data = {
+            "stamp_type": "entrata",
+            "when_days": [now.weekday()],
+            "when_time": f"{now:%H:%M}",
+        }
+        scheduler.add(
+            user_id,
+            schedule_data["when_days"],
+            schedule_data["when_time"],
+            {
+                "bot": harness.updater.bot,
+                "user_id": user_id,
+                "user_data": harness.dispatcher.user_data[user_id],
+                "schedule_data": schedule_data,
+            },
+        )
+
+    # the whole wave is due at the current minute, as at 9:15
+    scheduler.start(
+        harness.updater.job_queue,
+        bot.stamp_reminder,
+        lambda func, *args: bot.background_executor.submit(func, *args, block=True),
+    )
+
+    started = time.monotonic()
+    scheduler._tick(None)
+
+    return started, harness.telegram.wait(
+        "sendMessage", user_ids, timeout=options.timeout
+    )
+
+
+def broadcast(harness: Harness, options):
+    user_ids = harness.add_users(options.users)
+    os.environ["ADMIN_USERS"] = str(ADMIN_ID)
+
+    started = time.monotonic()
+    harness.command(ADMIN_ID, "/messaggio benchmark")
+
+    return started, harness.telegram.wait(
+        "sendMessage", user_ids, timeout=options.timeout
+    )
+
+
+SCENARIOS = {
+    "timbra": timbra,
+    "entra": entra,
+    "reminders": reminders,
+    "broadcast": broadcast,
+}
+
+
+def run(name: str, options) -> dict:
+    tracemalloc.start()
+    harness = Harness(options)
+    try:
+        tracemalloc.reset_peak()
+        started, times = SCENARIOS[name](harness, options)
+        _, peak = tracemalloc.get_traced_memory()
+        portal_requests = sum(harness.portal.requests.values())
+    finally:
+        harness.close()
+        tracemalloc.stop()
+
+    latencies = [t - started for t in times.values()]
+    elapsed = max(latencies) if latencies else float("nan")
+
+    return {
+        "scenario": name,
+        "users": options.users,
+        "completed": len(times),
+        "throughput": len(times) / elapsed if latencies else 0,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "max": elapsed,
+        "peak_mb": peak / 2**20,
+        "portal_requests": portal_requests,
+    }
+
+
+def report(result: dict) -> None:
+    print(
+        "{scenario:>10}: {completed}/{users} users, {throughput:.1f}/s, "
+        "p50 {p50:.3f}s, p99 {p99:.3f}s, max {max:.3f}s, "
+        "peak {peak_mb:.1f}MB, {portal_requests} portal requests".format(**result)
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenarios", nargs="*", default=list(SCENARIOS))
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3, help="/entra per user")
+    parser.add_argument("--jitter", type=float, default=0, help="reminder jitter")
+    parser.add_argument("--portal-latency", type=float, default=0.1)
+    parser.add_argument("--portal-errors", type=float, default=0)
+    parser.add_argument("--portal-expire", type=float, default=0)
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--verbose", action="store_true")
+    options = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO if options.verbose else logging.ERROR,
+    )
+
+    for name in options.scenarios:
+        report(run(name, options))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# A fake Telegram Bot API that answers the methods used by the bot and records
+# when every call reached each chat.
+
+import itertools
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "merdetti", "username": "bot"}
+
+
+class TelegramHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        telegram = self.server.telegram
+        method = self.path.rsplit("/", 1)[-1]
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        params = json.loads(body) if body else {}
+
+        if telegram.latency:
+            time.sleep(telegram.latency * random.uniform(0.5, 1.5))
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "editMessageText"):
+            result = {
+                "message_id": params.get("message_id") or next(telegram.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id") or 0), "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text") or "",
+            }
+        elif method == "getUpdates":
+            result = []
+        else:
+            result = True
+
+        telegram.record(method, params.get("chat_id"), params.get("text"))
+
+        data = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TelegramServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.02, port: int = 0) -> None:
+        self.latency = latency
+        self.message_ids = itertools.count(1)
+        self.listeners = []
+
+        self._calls = defaultdict(list)
+        self._condition = threading.Condition()
+        self._server = TelegramServer(("127.0.0.1", port), TelegramHandler)
+        self._server.telegram = self
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/bot"
+
+    def start(self) -> "FakeTelegram":
+        threading.Thread(
+            target=self._server.serve_forever, name="fake_telegram", daemon=True
+        ).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def record(self, method: str, chat_id, text: str = None) -> None:
+        chat_id = chat_id and int(chat_id)
+        with self._condition:
+            self._calls[(method, chat_id)].append(time.monotonic())
+            self._condition.notify_all()
+
+        for listener in self.listeners:
+            listener(method, chat_id, text)
+
+    def calls(self, method: str) -> int:
+        with self._condition:
+            return sum(len(t) for (m, _), t in self._calls.items() if m == method)
+
+    def wait(self, method: str, chat_ids, count: int = 1, timeout: float = 60) -> dict:
+        # the time of the count-th call of method to every chat, the chats that
+        # did not get it before the timeout are missing from the result
+        deadline = time.monotonic() + timeout
+        pending = set(chat_ids)
+        times = dict()
+
+        with self._condition:
+            while True:
+                for chat_id in list(pending):
+                    calls = self._calls.get((method, chat_id), [])
+                    if len(calls) >= count:
+                        times[chat_id] = calls[count - 1]
+                        pending.discard(chat_id)
+
+                remaining = deadline - time.monotonic()
+                if not pending or remaining <= 0:
+                    return times
+
+                self._condition.wait(remaining)
@@ -1,12 +1,24 @@
 #!/usr/bin/env python3
 
+import time
+
+started = time.monotonic()
+
 import logging
 import os
 import sys
 
 from dotenv import load_dotenv
 
+# the settings are read when the modules are imported, so .env is loaded first
+env_loaded = load_dotenv()
+
+from merdetti import shards
 from merdetti.bot import run
+from merdetti.startup import StartupProfile
+
+profile = StartupProfile(started)
+profile.mark("import")
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -15,8 +27,24 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def webhook_config():
+    listen = os.getenv("WEBHOOK_LISTEN")
+    if not listen:
+        return None
+
+    host, _, port = listen.rpartition(":")
+    return {
+        "listen": host or "0.0.0.0",
+        "port": int(port),
+        "path": os.getenv("WEBHOOK_PATH") or "/telegram",
+        "secret": os.getenv("WEBHOOK_SECRET"),
+        "webhook_url": os.getenv("WEBHOOK_URL"),
+        "max_connections": int(os.getenv("WEBHOOK_MAX_CONNECTIONS") or 40),
+    }
+
+
 def main():
-    if not load_dotenv():
+    if not env_loaded:
         logger.debug("Failed to load environment variables from .env file")
 
     required_vars = ["TELEGRAM_TOKEN", "ZUCCHETTI_BASE_URL"]
@@ -25,7 +53,11 @@ def main():
             logger.error(f"{var} variable not present")
             return False
 
-    run()
+    workers = int(os.getenv("WORKERS") or 4)
+    if shards.SHARDS > 1:
+        shards.run(profile, webhook_config(), workers=workers)
+    else:
+        run(profile, webhook_config(), workers=workers)
 
     return True
 
@@ -1,29 +1,43 @@
 import logging
 import os
 import re
+import threading
+from functools import partial
+from queue import Queue
 
-from telegram import Update
+from telegram import Bot, Update
 from telegram.ext import (
     CallbackContext,
-    CallbackQueryHandler,
     CommandHandler,
-    Filters,
-    MessageHandler,
-    PicklePersistence,
+    Dispatcher,
+    JobQueue,
+    TypeHandler,
     Updater,
 )
 
-from . import notifications
-from .zucchetti import ApiError, InvalidCredentials, ZucchettiApi
+from . import broadcast, metrics, notifications, webhook
+from .limiter import PRIORITY_BACKGROUND, priority
+from .persistence import SQLitePersistence
+from .router import Router
+from .session_store import SessionStore
+from .startup import StartupProfile
+from .zucchetti import ApiError, InvalidCredentials, PortalUnavailable, ZucchettiApi
 
 from .constants import *
+from .executor import (
+    BACKGROUND_WORKERS,
+    PORTAL_WORKERS,
+    background_executor,
+    portal_executor,
+)
 from .helpers import (
     admin_user,
     callback,
-    callback_pattern,
     command,
     logged_user,
     make_keyboard,
+    portal_task,
+    rate_limited,
 )
 
 CANCEL_CALLBACK, ENTER_CALLBACK, EXIT_CALLBACK = (
@@ -34,6 +48,8 @@ CANCEL_CALLBACK, ENTER_CALLBACK, EXIT_CALLBACK = (
 
 KIND_CREDENTIALS = "credentials"
 
+LAZY_STARTUP = os.getenv("LAZY_STARTUP", "").lower() in ("1", "true", "yes")
+
 logger = logging.getLogger(__name__)
 
 
@@ -41,9 +57,56 @@ LOGIN_MESSAGE = (
     "Inserisci le tue credenziali di Zucchetti 🔐, separate da uno spazio.\n\n"
     "Dovrò salvare le tue credenziali in memoria per non richiederti le credenziali tutte le volte, ma non le scriverò da nessuna parte. Lo giuro! 🙇🏽‍♂️"
 )
+LOGIN_STORED_MESSAGE = (
+    "Inserisci le tue credenziali di Zucchetti 🔐, separate da uno spazio.\n\n"
+    "Dovrò salvare le tue credenziali cifrate su disco per non richiedertele tutte le volte, anche dopo un mio riavvio 🙇🏽‍♂️"
+)
 
 
 zucchetti_users = dict()
+session_store = None
+
+
+def store_session(user_id: int, zucchetti_api: ZucchettiApi) -> None:
+    if session_store:
+        try:
+            session_store.save(user_id, zucchetti_api.dump_state())
+        except OSError as e:
+            logger.error("Failed to save the session of user %s: %s", user_id, e)
+
+
+def login_message() -> str:
+    return LOGIN_STORED_MESSAGE if session_store else LOGIN_MESSAGE
+
+
+def has_session(user_id: int) -> bool:
+    return user_id in zucchetti_users or bool(
+        session_store and session_store.exists(user_id)
+    )
+
+
+def forget_session(user_id: int) -> None:
+    # the stored password is not valid anymore, it must not be restored again
+    zucchetti_users.pop(user_id, None)
+    if session_store:
+        session_store.delete(user_id)
+
+
+def user_api(user_id: int):
+    zucchetti_api = zucchetti_users.get(user_id)
+    if zucchetti_api or not session_store:
+        return zucchetti_api
+
+    state = session_store.load(user_id)
+    if not state:
+        return None
+
+    zucchetti_api = ZucchettiApi.from_state(
+        state,
+        on_login=partial(store_session, user_id),
+        login_limiter=session_store.login_limiter,
+    )
+    return zucchetti_users.setdefault(user_id, zucchetti_api)
 
 
 @command
@@ -58,13 +121,13 @@ def start_command(update: Update, context: CallbackContext):
 @command
 def login_command(update: Update, context: CallbackContext):
     context.user_data[INPUT_KIND] = KIND_CREDENTIALS
-    update.message.reply_text(LOGIN_MESSAGE)
+    update.message.reply_text(login_message())
 
 
 @callback
 def login_callback(update: Update, context: CallbackContext):
     context.user_data[INPUT_KIND] = KIND_CREDENTIALS
-    update.callback_query.edit_message_text(LOGIN_MESSAGE)
+    update.callback_query.edit_message_text(login_message())
 
 
 def credentials_input(update: Update, context: CallbackContext):
@@ -76,31 +139,44 @@ def credentials_input(update: Update, context: CallbackContext):
         )
         return
 
-    zucchetti_api = ZucchettiApi(match[1], match[2])
+    context.user_data[INPUT_KIND] = None
+    if not verify_credentials(update, context, match[1], match[2]):
+        # not verified because overloaded, the credentials can be sent again
+        context.user_data[INPUT_KIND] = KIND_CREDENTIALS
+
+
+@portal_task("⏳ Verifico le credenziali..")
+def verify_credentials(
+    update: Update, context: CallbackContext, reply, username: str, password: str
+):
+    zucchetti_api = ZucchettiApi(
+        username,
+        password,
+        on_login=partial(store_session, update.effective_user.id),
+    )
     try:
         zucchetti_api.login()
     except InvalidCredentials:
-        update.message.reply_text(
+        reply(
             "Le credenziali che hai inserito non sono corrette!\n"
             "Inseriscile nuovamente (quelle giuste magari 😅)"
         )
+
+        context.user_data[INPUT_KIND] = KIND_CREDENTIALS
         return
     except ApiError as e:
-        update.message.reply_text(
+        reply(
             "Non sono riuscito a verificare le tue credenziali 😓. Riprova più tardi rieffettuando il /login"
         )
 
         logger.warning(
-            f"Failed to authenticate a user {update.message.from_user.first_name}: {e}"
+            f"Failed to authenticate a user {update.effective_user.first_name}: {e}"
         )
 
-        context.user_data[INPUT_KIND] = None
-
         return
 
     zucchetti_users[update.effective_user.id] = zucchetti_api
     context.user_data[LOGGED] = True
-    context.user_data[INPUT_KIND] = None
 
     logger.info(
         "User %s (%s) logged in",
@@ -108,79 +184,79 @@ def credentials_input(update: Update, context: CallbackContext):
         update.effective_user.first_name,
     )
 
-    update.message.reply_text(
+    reply(
         "Credenziali salvate con successo!\n\nUsa /timbra per timbrare 🎫\nUsa /notifiche per impostare gli avvisi 📢"
     )
 
 
-def user_input(update: Update, context: CallbackContext):
-    input_kinds = [
-        (KIND_CREDENTIALS, credentials_input)
-    ] + notifications.user_input_handlers(stamp_reminder)
+def forgotten_credentials(reply, context: CallbackContext) -> None:
+    reply(
+        text=(
+            f"Scusami tanto, ma mi sono dimenticato le tue credenziali 😕\n"
+            "Devi rieffettiare il login per timbrare nuovamente"
+        ),
+        reply_markup=make_keyboard(("Login", LOGIN_CALLBACK), context),
+    )
 
-    for input_kind, input_callback in input_kinds:
-        if context.user_data.get(INPUT_KIND) == input_kind:
-            input_callback(update, context)
 
-            return
+def check_session(update: Update, context: CallbackContext) -> bool:
+    if has_session(update.effective_user.id):
+        return True
 
+    if update.callback_query:
+        forgotten_credentials(update.callback_query.edit_message_text, context)
+    else:
+        forgotten_credentials(update.message.reply_text, context)
 
-def get_zucchetti_api(update: Update, context: CallbackContext):
-    zucchetti_api = zucchetti_users.get(update.effective_user.id)
+    context.user_data[LOGGED] = False
+    return False
 
-    if not zucchetti_api:
-        message = (
-            f"Scusami tanto, ma mi sono dimenticato le tue credenziali 😕\n"
-            "Devi rieffettiare il login per timbrare nuovamente"
-        )
-        keyboard = make_keyboard(("Login", LOGIN_CALLBACK), context)
 
-        if update.callback_query:
-            update.callback_query.edit_message_text(text=message, reply_markup=keyboard)
-        else:
-            update.message.reply_text(text=message, reply_markup=keyboard)
+def get_zucchetti_api(update: Update, context: CallbackContext, reply):
+    # called by the portal tasks: restoring a stored session waits for the
+    # restore rate, which must not hold a dispatcher worker
+    zucchetti_api = user_api(update.effective_user.id)
+    if not zucchetti_api:
+        forgotten_credentials(reply, context)
+        context.user_data[LOGGED] = False
 
     return zucchetti_api
 
 
+def invalid_credentials(update: Update, context: CallbackContext, reply) -> None:
+    reply(
+        text="Le credenziali che avevi precedentemente inserito non sono più valide 🙁",
+        reply_markup=make_keyboard(("Login", LOGIN_CALLBACK), context),
+    )
+
+    forget_session(update.effective_user.id)
+    context.user_data[LOGGED] = False
+
+
 @command
 @logged_user
+@rate_limited
 def stamp_command(update: Update, context: CallbackContext):
-    zucchetti_api = get_zucchetti_api(update, context)
-    if not zucchetti_api:
-        context.user_data[LOGGED] = False
-        return
-
-    try:
-        zucchetti_api.login()
-    except InvalidCredentials:
-        update.message.reply_text(
-            text="Le credenziali che avevi precedentemente inserito non sono più valide 🙁",
-            reply_markup=make_keyboard(("Login", LOGIN_CALLBACK), context),
-        )
-
-        context.user_data[LOGGED] = False
-        return
-    except ApiError as e:
-        update.message.reply_text(
-            "⚠️ Non riesco a effettuare il login. Riprova più tardi.."
-        )
+    if check_session(update, context):
+        stamp_status(update, context)
 
-        logger.warning(
-            f"Failed to authenticate a user {update.message.from_user.first_name}: {e}"
-        )
 
+@portal_task("⏳ Controllo il cartellino..")
+def stamp_status(update: Update, context: CallbackContext, reply):
+    zucchetti_api = get_zucchetti_api(update, context, reply)
+    if not zucchetti_api:
         return
 
     try:
         last_stamps = zucchetti_api.last_stamps()
+    except InvalidCredentials:
+        invalid_credentials(update, context, reply)
+        return
     except ApiError as e:
-        update.message.reply_text(
-            "⚠️ Non riesco a ottenere lo stato del cartellino. Riprova più tardi.."
-        )
+        reply("⚠️ Non riesco a ottenere lo stato del cartellino. Riprova più tardi..")
 
         logger.warning(
-            f"Failed to obtain status for user {update.message.from_user.first_name}: {e}"
+            f"Failed to obtain status for user {update.effective_user.first_name}: {e}"
         )
 
         return
@@ -196,9 +272,7 @@ def stamp_command(update: Update, context: CallbackContext):
 
     message += "\n\n" + stamp_message(last_stamps)
 
-    update.message.reply_text(
-        text=message, reply_markup=make_keyboard([buttons], context)
-    )
+    reply(text=message, reply_markup=make_keyboard([buttons], context))
 
 
 @callback
@@ -217,16 +291,18 @@ def exit_callback(update: Update, context: CallbackContext):
 
 
 @logged_user
+@rate_limited
 def stamp(update: Update, context: CallbackContext, enter: bool):
-    zucchetti_api = get_zucchetti_api(update, context)
+    if check_session(update, context):
+        stamp_portal(update, context, enter)
+
+
+@portal_task("⏳ Sto timbrando..")
+def stamp_portal(update: Update, context: CallbackContext, reply, enter: bool):
+    zucchetti_api = get_zucchetti_api(update, context, reply)
     if not zucchetti_api:
         return
 
-    if update.message:
-        reply = update.message.reply_text
-    else:
-        reply = update.callback_query.edit_message_text
-
     try:
         if enter:
             zucchetti_api.enter()
@@ -234,11 +310,14 @@ def stamp(update: Update, context: CallbackContext, enter: bool):
             zucchetti_api.exit()
 
         last_stamps = zucchetti_api.last_stamps()
+    except InvalidCredentials:
+        invalid_credentials(update, context, reply)
+        return
     except ApiError as e:
         reply("⚠️ Non riesco a timbrare. Riprova più tardi..")
 
         logger.warning(
-            f"Failed to stamp for user {update.callback_query.from_user.first_name}: {e}"
+            f"Failed to stamp for user {update.effective_user.first_name}: {e}"
         )
 
         return
@@ -259,10 +338,15 @@ def message_command(update: Update, context: CallbackContext):
     if message == "":
         return
 
-    for user_id, _ in context.dispatcher.persistence.get_user_data().items():
-        context.bot.send_message(
-            chat_id=user_id, text=f"{update.effective_user.first_name}: {message}"
-        )
+    user_ids = context.dispatcher.persistence.user_ids()
+    broadcast.start(
+        context,
+        update.effective_user.id,
+        f"{update.effective_user.first_name}: {message}",
+        user_ids,
+    )
+
+    update.message.reply_text(f"Sto inviando il messaggio a {len(user_ids)} utenti 📨")
 
 
 def stamp_message(stamps: list) -> str:
@@ -274,16 +358,17 @@ def stamp_message(stamps: list) -> str:
     )
 
 
-def stamp_reminder(context) -> None:
-    bot = context.job.context["bot"]
-    user_id = context.job.context["user_id"]
-    user_data = context.job.context["user_data"]
-    schedule_data = context.job.context["schedule_data"]
+def stamp_reminder(reminder: dict) -> None:
+    bot = reminder["bot"]
+    user_id = reminder["user_id"]
+    user_data = reminder["user_data"]
+    schedule_data = reminder["schedule_data"]
 
     user_data[INPUT_KIND] = None
 
     stamp_type = schedule_data["stamp_type"]
-    zucchetti_api = zucchetti_users.get(user_id)
+    with priority(PRIORITY_BACKGROUND):
+        zucchetti_api = user_api(user_id)
     if not zucchetti_api:
         message = f"Hey! Forse dovresti timbrare l'{stamp_type}, ma non ho più le tue credenziali per poter verificare 😕"
         bot.send_message(
@@ -294,31 +379,39 @@ def stamp_reminder(context) -> None:
         return
 
     error_message = f"Hey! Dovresti tibrare l'{stamp_type}, "
+    portal_down_message = (
+        error_message + "ma il portale di Zucchetti non risponde in questo momento 🙁"
+    )
+
+    # the portal is known to be down, do not make the user wait for nothing
+    if not zucchetti_api.breaker.available:
+        bot.send_message(chat_id=user_id, text=portal_down_message)
+        return
+
     try:
-        zucchetti_api.login()
+        with priority(PRIORITY_BACKGROUND):
+            # the stamps pre-warmed before the reminder are still good enough
+            last_stamps = zucchetti_api.last_stamps(
+                max_age=notifications.reminder_scheduler.prewarm_age or None
+            )
     except InvalidCredentials:
         bot.send_message(
             chat_id=user_id,
             text=error_message
             + "ma le credenziali che avevi precedentemente inserito non sono più valide 🙁",
-            reply_markup=make_keyboard(("Login", LOGIN_CALLBACK), context),
+            reply_markup=make_keyboard(("Login", LOGIN_CALLBACK), user_data=user_data),
         )
 
+        forget_session(user_id)
         return
-    except ApiError:
-        bot.send_message(
-            chat_id=user_id,
-            text=error_message
-            + "ma non riesco ad accedere al portale per verificare 🙁",
-        )
+    except PortalUnavailable:
+        bot.send_message(chat_id=user_id, text=portal_down_message)
         return
-
-    try:
-        last_stamps = zucchetti_api.last_stamps()
     except ApiError:
         bot.send_message(
             chat_id=user_id,
-            text=error_message + "ma non riesco a verificare lo stato del cartellino 🙁",
+            text=error_message
+            + "ma non riesco a verificare lo stato del cartellino 🙁",
         )
         return
 
@@ -341,40 +434,175 @@ def stamp_reminder(context) -> None:
     bot.send_message(chat_id=user_id, text=message, reply_markup=keyboard)
 
 
+def prewarm_reminder(reminder: dict) -> None:
+    user_id = reminder["user_id"]
+    prewarm_age = notifications.reminder_scheduler.prewarm_age
+
+    with priority(PRIORITY_BACKGROUND):
+        zucchetti_api = user_api(user_id)
+        if not zucchetti_api:
+            return
+
+        try:
+            zucchetti_api.last_stamps(max_age=0, ttl=prewarm_age)
+        except (ApiError, InvalidCredentials) as e:
+            # the reminder tries again and tells the user when it fires
+            logger.debug("Failed to pre-warm the reminder of user %s: %s", user_id, e)
+
+
 @command
 def notification_command(update: Update, context: CallbackContext):
     notifications.main_menu(update, context)
 
 
-def run() -> None:
+def make_router() -> Router:
+    router = Router()
+    router.add_callbacks(
+        [
+            (LOGIN_CALLBACK, login_callback),
+            (CANCEL_CALLBACK, cancel_callback),
+            (ENTER_CALLBACK, enter_callback),
+            (EXIT_CALLBACK, exit_callback),
+        ]
+        + notifications.callback_routes()
+    )
+    router.add_inputs(
+        [(KIND_CREDENTIALS, credentials_input)] + notifications.user_input_handlers()
+    )
+
+    return router
+
+
+def handlers() -> list:
+    commands = [
+        ("start", start_command),
+        ("login", login_command),
+        ("timbra", stamp_command),
+        ("entra", enter_callback),
+        ("esci", exit_callback),
+        ("messaggio", message_command),
+        ("notifiche", notification_command),
+    ]
+
+    return [
+        CommandHandler(name, metrics.timed_handler(f"/{name}", func))
+        for name, func in commands
+    ] + make_router().handlers()
+
+
+def make_persistence(data_dir: str, shard=None) -> SQLitePersistence:
+    return SQLitePersistence(
+        os.path.join(data_dir, "bot.sqlite"),
+        migrate_from=os.path.join(data_dir, "bot.db"),
+        owns_user=shard.owns if shard else None,
+        bot_data_key=shard.bot_data_key if shard else "bot_data",
+    )
+
+
+def telegram_pool_size(workers: int) -> int:
+    # the portal and reminder threads answer the users too, besides the
+    # dispatcher workers, the job queue and the updater
+    return workers + PORTAL_WORKERS + BACKGROUND_WORKERS + 4
+
+
+# The jobs change only bot_data, the broadcasts: the whole persistence update
+# made after each of them pickled every loaded user every minute, and every
+# second of a broadcast. Should a new version of PTB drop the hook, the jobs
+# would just save everything again.
+class BotDataJobQueue(JobQueue):
+    __slots__ = ("_bot_dispatcher",)
+
+    def set_dispatcher(self, dispatcher: Dispatcher) -> None:
+        super().set_dispatcher(dispatcher)
+        self._bot_dispatcher = dispatcher
+
+    def _update_persistence(self, event) -> None:
+        dispatcher = self._bot_dispatcher
+        if dispatcher.persistence:
+            dispatcher.persistence.update_bot_data(dispatcher.bot_data)
+
+
+def make_updater(bot: Bot, persistence: SQLitePersistence, workers: int) -> Updater:
+    job_queue = BotDataJobQueue()
+    dispatcher = Dispatcher(
+        bot, Queue(), workers=workers, job_queue=job_queue, persistence=persistence
+    )
+    job_queue.set_dispatcher(dispatcher)
+
+    # the workers are those of the dispatcher
+    return Updater(dispatcher=dispatcher, workers=None)
+
+
+def run(
+    profile: StartupProfile = None, webhook_config: dict = None, workers=4, shard=None
+) -> None:
+    global session_store
+
+    profile = profile or StartupProfile()
+
     data_dir = os.getenv("DATA_DIR") or os.getcwd()
-    persistence = PicklePersistence(filename=os.path.join(data_dir, "bot.db"))
-    updater = Updater(os.getenv("TELEGRAM_TOKEN"), persistence=persistence)
+    if os.getenv("SESSION_STORE_KEY"):
+        session_store = SessionStore(
+            os.path.join(data_dir, "sessions"), os.getenv("SESSION_STORE_KEY")
+        )
+    else:
+        logger.info("SESSION_STORE_KEY not set, the sessions are kept in memory")
+    persistence = make_persistence(data_dir, shard)
+    bot = Bot(
+        os.getenv("TELEGRAM_TOKEN"),
+        base_url=os.getenv("TELEGRAM_BASE_URL"),
+        request=metrics.TimedRequest(con_pool_size=telegram_pool_size(workers)),
+    )
+    updater = make_updater(bot, persistence, workers)
 
     dispatcher = updater.dispatcher
+    profile.mark("load")
+
+    def first_update(update: Update, context: CallbackContext):
+        if not profile.marked("first update"):
+            profile.mark("first update")
+            profile.report()
+
+    def schedule_reminders():
+        # reminders wait for a free slot instead of being dropped
+        notifications.setup_scheduler(
+            updater,
+            stamp_reminder,
+            submit=partial(background_executor.submit, block=True),
+            prewarm_callback=prewarm_reminder,
+            lease=shard.lease(data_dir) if shard else None,
+        )
+        profile.mark("schedule")
 
-    handlers = [
-        CommandHandler("start", start_command),
-        CommandHandler("login", login_command),
-        CommandHandler("timbra", stamp_command),
-        CommandHandler("entra", enter_callback),
-        CommandHandler("esci", exit_callback),
-        CommandHandler("messaggio", message_command),
-        CommandHandler("notifiche", notification_command),
-        CallbackQueryHandler(login_callback, pattern=callback_pattern(LOGIN_CALLBACK)),
-        CallbackQueryHandler(
-            cancel_callback, pattern=callback_pattern(CANCEL_CALLBACK)
-        ),
-        CallbackQueryHandler(enter_callback, pattern=callback_pattern(ENTER_CALLBACK)),
-        CallbackQueryHandler(exit_callback, pattern=callback_pattern(EXIT_CALLBACK)),
-        MessageHandler(Filters.text & ~Filters.command, user_input),
-    ] + notifications.handlers(stamp_reminder)
+        if LAZY_STARTUP:
+            profile.report("Reminders indexed")
+
+    if LAZY_STARTUP:
+        # reminders are indexed while the bot already serves updates
+        threading.Thread(
+            target=schedule_reminders, name="reminders_index", daemon=True
+        ).start()
+    else:
+        schedule_reminders()
 
-    notifications.setup_scheduler(updater, stamp_reminder)
+    broadcast.resume(updater)
+    metrics_port = metrics.METRICS_PORT
+    if shard and metrics_port:
+        # every shard serves its own metrics, on consecutive ports
+        metrics_port += shard.index
+    metrics.start(dispatcher, portal_executor, background_executor, metrics_port)
 
-    for handler in handlers:
+    dispatcher.add_handler(TypeHandler(Update, first_update), group=-1)
+    for handler in handlers():
         dispatcher.add_handler(handler)
 
-    updater.start_polling()
+    if shard:
+        shard.start(updater)
+    elif webhook_config:
+        webhook.start(updater, **webhook_config)
+    else:
+        updater.start_polling()
+    profile.mark("polling")
+    profile.report()
 
     updater.idle()
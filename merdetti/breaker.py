@@ -0,0 +1,160 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from .metrics import PORTAL_BREAKER_OPEN, PORTAL_TIMEOUT
+
+BREAKER_FAILURES = int(os.getenv("PORTAL_BREAKER_FAILURES") or 5)
+BREAKER_RESET = float(os.getenv("PORTAL_BREAKER_RESET") or 30)
+MIN_TIMEOUT = float(os.getenv("PORTAL_MIN_TIMEOUT") or 2)
+TIMEOUT_FACTOR = 3
+LATENCY_WINDOW = 200
+LATENCY_SAMPLES = 20
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+logger = logging.getLogger(__name__)
+
+
+# The breaker opens after a number of consecutive failures, so the calls fail
+# at once instead of waiting for the timeout. After reset seconds a single call
+# is let through as a probe: it closes the breaker if it succeeds, otherwise
+# the breaker stays open for another reset period.
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        max_timeout: float,
+        failures: int = BREAKER_FAILURES,
+        reset: float = BREAKER_RESET,
+        min_timeout: float = MIN_TIMEOUT,
+    ) -> None:
+        self._name = name
+        self._failures = failures
+        self._reset = reset
+        self._min_timeout = min_timeout
+        self._max_timeout = max_timeout
+
+        self._state = CLOSED
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._samples = 0
+        self._timeout = max_timeout
+        self._lock = threading.Lock()
+
+        PORTAL_TIMEOUT.labels(name).set(max_timeout)
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self._reset:
+            return HALF_OPEN
+
+        return self._state
+
+    @property
+    def available(self) -> bool:
+        return self.state != OPEN
+
+    @property
+    def retry_after(self) -> float:
+        with self._lock:
+            if self._state == CLOSED:
+                return 0
+
+            return max(self._opened_at + self._reset - time.monotonic(), 0)
+
+    @property
+    def timeout(self) -> float:
+        return self._timeout
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+
+            return False
+
+    def success(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+            self._samples += 1
+            if self._samples % LATENCY_SAMPLES == 0:
+                self._update_timeout()
+            elif latency * TIMEOUT_FACTOR > self._timeout:
+                # a slower portal is followed at once, not after the next samples
+                self._set_timeout(latency * TIMEOUT_FACTOR)
+
+            self._consecutive = 0
+            self._probing = False
+            if self._state != CLOSED:
+                self._state = CLOSED
+                PORTAL_BREAKER_OPEN.labels(self._name).set(0)
+                logger.info("Portal %s is back, closing the breaker", self._name)
+
+    def slower(self, timeout: float):
+        # a call that timed out while the others succeed says the portal got
+        # slower than the recent calls, not that it is down: it can be tried once
+        # more with a longer timeout; once the calls fail they fail fast
+        with self._lock:
+            if (
+                self._state != CLOSED
+                or self._consecutive
+                or timeout >= self._max_timeout
+            ):
+                return None
+
+            return min(timeout * 2, self._max_timeout)
+
+    def failure(self, count: int = 1) -> None:
+        with self._lock:
+            self._consecutive += count
+            probe_failed = self._probing
+            self._probing = False
+
+            if probe_failed or (
+                self._state == CLOSED and self._consecutive >= self._failures
+            ):
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                PORTAL_BREAKER_OPEN.labels(self._name).set(1)
+                logger.warning(
+                    "Portal %s failed %d times in a row, opening the breaker",
+                    self._name,
+                    self._consecutive,
+                )
+
+    def _update_timeout(self) -> None:
+        # a few times the recent 99th percentile, so a slow portal is waited
+        # for, while a dead one is given up on well before the fixed maximum
+        latencies = sorted(self._latencies)
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        self._set_timeout(p99 * TIMEOUT_FACTOR)
+
+    def _set_timeout(self, timeout: float) -> None:
+        self._timeout = min(max(timeout, self._min_timeout), self._max_timeout)
+        PORTAL_TIMEOUT.labels(self._name).set(self._timeout)
+
+
+_breakers = dict()
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(base_url: str, max_timeout: float) -> CircuitBreaker:
+    with _breakers_lock:
+        if base_url not in _breakers:
+            _breakers[base_url] = CircuitBreaker(base_url, max_timeout)
+
+        return _breakers[base_url]
@@ -0,0 +1,127 @@
+import logging
+import os
+import time
+
+from telegram.error import BadRequest, RetryAfter, TelegramError, Unauthorized
+from telegram.ext import CallbackContext, JobQueue
+from telegram.ext.updater import Updater
+
+BROADCASTS = "broadcasts"
+
+BROADCAST_RATE = int(os.getenv("BROADCAST_RATE") or 30)
+BATCH_INTERVAL = 1
+
+logger = logging.getLogger(__name__)
+
+
+def start(context: CallbackContext, admin_id: int, text: str, user_ids: list) -> dict:
+    broadcast = {
+        "admin_id": admin_id,
+        "text": text,
+        "user_ids": list(user_ids),
+        "position": 0,
+        "sent": 0,
+        "failed": 0,
+        "started": time.time(),
+        "resume_at": 0,
+    }
+
+    broadcasts = context.bot_data.setdefault(BROADCASTS, [])
+    broadcasts.append(broadcast)
+
+    logger.info(
+        "Admin %s started a broadcast to %d users", admin_id, len(broadcast["user_ids"])
+    )
+
+    if len(broadcasts) == 1:
+        _schedule(context.job_queue, 0)
+
+    return broadcast
+
+
+def resume(updater: Updater) -> None:
+    broadcasts = updater.dispatcher.bot_data.get(BROADCASTS)
+    if broadcasts:
+        logger.info("Resuming %d interrupted broadcasts", len(broadcasts))
+        _schedule(updater.job_queue, 0)
+
+
+def _schedule(job_queue: JobQueue, when: float) -> None:
+    job_queue.run_once(_send_batch, when, name="broadcast")
+
+
+def _send_batch(context: CallbackContext) -> None:
+    broadcasts = context.bot_data.get(BROADCASTS)
+    if not broadcasts:
+        return
+
+    broadcast = broadcasts[0]
+    wait = broadcast["resume_at"] - time.time()
+    if wait > 0:
+        _schedule(context.job_queue, wait)
+        return
+
+    started = time.monotonic()
+    user_ids = broadcast["user_ids"]
+
+    # progress is kept in bot_data, which is persisted after every batch, so a
+    # restart goes on from the last recipient reached
+    for _ in range(BROADCAST_RATE):
+        if broadcast["position"] >= len(user_ids):
+            break
+
+        user_id = user_ids[broadcast["position"]]
+        try:
+            context.bot.send_message(chat_id=user_id, text=broadcast["text"])
+            broadcast["sent"] += 1
+        except RetryAfter as e:
+            logger.warning("Broadcast flood limit reached, waiting %ss", e.retry_after)
+            broadcast["resume_at"] = time.time() + e.retry_after
+            _schedule(context.job_queue, e.retry_after)
+            return
+        except (Unauthorized, BadRequest) as e:
+            logger.info("Broadcast not delivered to user %s: %s", user_id, e)
+            broadcast["failed"] += 1
+        except TelegramError as e:
+            logger.warning("Broadcast failed for user %s: %s", user_id, e)
+            broadcast["failed"] += 1
+
+        broadcast["position"] += 1
+
+    if broadcast["position"] < len(user_ids):
+        _schedule(
+            context.job_queue, max(0, BATCH_INTERVAL - (time.monotonic() - started))
+        )
+        return
+
+    broadcasts.pop(0)
+    _report(context, broadcast)
+
+    if broadcasts:
+        _schedule(context.job_queue, 0)
+
+
+def _report(context: CallbackContext, broadcast: dict) -> None:
+    elapsed = max(time.time() - broadcast["started"], 1)
+    throughput = broadcast["sent"] / elapsed
+
+    logger.info(
+        "Broadcast of admin %s completed: %d sent, %d failed in %ds",
+        broadcast["admin_id"],
+        broadcast["sent"],
+        broadcast["failed"],
+        elapsed,
+    )
+
+    try:
+        context.bot.send_message(
+            chat_id=broadcast["admin_id"],
+            text=(
+                f"Messaggio inviato 📢\n\n"
+                f"Consegnati: {broadcast['sent']}\n"
+                f"Non consegnati: {broadcast['failed']}\n"
+                f"Durata: {int(elapsed)}s ({throughput:.1f} messaggi/s)"
+            ),
+        )
+    except TelegramError as e:
+        logger.warning("Failed to send broadcast report: %s", e)
@@ -0,0 +1,61 @@
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+PORTAL_WORKERS = int(os.getenv("PORTAL_WORKERS") or 16)
+PORTAL_QUEUE_SIZE = int(os.getenv("PORTAL_QUEUE_SIZE") or 256)
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS") or 8)
+BACKGROUND_QUEUE_SIZE = int(os.getenv("BACKGROUND_QUEUE_SIZE") or 256)
+
+logger = logging.getLogger(__name__)
+
+
+class ExecutorBusy(Exception):
+    pass
+
+
+class BoundedExecutor:
+    def __init__(self, workers: int, queue_size: int, name: str) -> None:
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=name
+        )
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, block: bool = False) -> Future:
+        if not self._slots.acquire(blocking=block):
+            raise ExecutorBusy()
+
+        with self._lock:
+            self._pending += 1
+
+        try:
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._done(None)
+            raise
+
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future) -> None:
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+        if future is not None and future.exception() is not None:
+            logger.error("Portal task failed", exc_info=future.exception())
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+
+portal_executor = BoundedExecutor(PORTAL_WORKERS, PORTAL_QUEUE_SIZE, "portal")
+# the reminders have their own workers, so a wave of them never delays or
+# rejects the commands of the users
+background_executor = BoundedExecutor(
+    BACKGROUND_WORKERS, BACKGROUND_QUEUE_SIZE, "background"
+)
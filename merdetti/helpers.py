@@ -1,26 +1,32 @@
 import logging
 import os
-import re
-import uuid
+import random
+from functools import lru_cache
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CallbackContext
 
 from .constants import *
+from .executor import ExecutorBusy, portal_executor
+from .limiter import user_limiter
 
 CALLBACK_SESSION = "callback_session"
 
+# 6 base36 characters instead of the 36 of an uuid in every callback_data
+SESSION_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+SESSION_SPACE = len(SESSION_DIGITS) ** 6
+
 logger = logging.getLogger(__name__)
 
 
 def make_keyboard(buttons: list, context: CallbackContext = None, user_data: dict = None):
     keyboard = []
 
-    session = str(uuid.uuid4())
     if context:
-        context.user_data[CALLBACK_SESSION] = session
-    else:
-        user_data[CALLBACK_SESSION] = session
+        user_data = context.user_data
+
+    session = next_session(user_data.get(CALLBACK_SESSION))
+    user_data[CALLBACK_SESSION] = session
 
     if isinstance(buttons, list):
         for row in buttons:
@@ -46,6 +52,32 @@ def make_keyboard(buttons: list, context: CallbackContext = None, user_data: dic
     return InlineKeyboardMarkup(keyboard)
 
 
+# Each keyboard of a user gets the next value of a per-user counter, so only
+# the newest keyboard is accepted. The counter starts from a random value to not
+# accept the keyboards sent before a restart, when the session is not persisted.
+def next_session(session: str = None) -> str:
+    if valid_session(session):
+        counter = int(session, 36) + 1
+    else:
+        counter = random.randrange(SESSION_SPACE)
+
+    digits = []
+    for _ in range(6):
+        counter, digit = divmod(counter, len(SESSION_DIGITS))
+        digits.append(SESSION_DIGITS[digit])
+
+    return "".join(reversed(digits))
+
+
+# the sessions saved before, like the uuids of the older versions, are replaced
+def valid_session(session) -> bool:
+    return (
+        isinstance(session, str)
+        and len(session) == 6
+        and all(digit in SESSION_DIGITS for digit in session)
+    )
+
+
 def logged_user(func):
     def wrapper(*args, **kwargs):
         update, context = args[0], args[1]
@@ -92,12 +124,8 @@ def callback(func):
 
         update.callback_query.answer()
 
-        match = re.match(r"^([\w]+)#([\w-]+)$", update.callback_query.data)
-        if not match:
-            update.callback_query.delete_message()
-            return
-
-        if match[2] != context.user_data.get(CALLBACK_SESSION):
+        _, session = split_callback_data(update.callback_query.data)
+        if not session or session != context.user_data.get(CALLBACK_SESSION):
             update.callback_query.delete_message()
             return
 
@@ -106,8 +134,31 @@ def callback(func):
     return wrapper
 
 
-def callback_pattern(key):
-    return "^" + key + "#[\w-]+$"
+# the router and the callback decorator split the same data one after the other
+@lru_cache(maxsize=1024)
+def split_callback_data(data: str) -> tuple:
+    action, separator, session = data.partition("#")
+    if not separator:
+        return action, None
+
+    return action, session
+
+
+def rate_limited(func):
+    def wrapper(*args, **kwargs):
+        update = args[0]
+
+        if user_limiter.allow(update.effective_user.id):
+            func(*args, **kwargs)
+            return
+
+        message = "✋ Stai andando troppo veloce, riprova tra qualche secondo.."
+        if update.callback_query:
+            update.callback_query.edit_message_text(text=message)
+        else:
+            update.message.reply_text(text=message)
+
+    return wrapper
 
 
 def command(func):
@@ -119,3 +170,36 @@ def command(func):
         func(*args, **kwargs)
 
     return wrapper
+
+
+def portal_task(working_message: str):
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            update, context = args[0], args[1]
+
+            if update.callback_query:
+                message = update.callback_query.edit_message_text(working_message)
+            else:
+                message = update.message.reply_text(working_message)
+
+            # the portal may take long to answer: the call runs on the portal
+            # executor and the working message is edited with the result
+            def task():
+                try:
+                    func(update, context, message.edit_text, *args[2:], **kwargs)
+                finally:
+                    context.dispatcher.update_persistence(update)
+
+            try:
+                portal_executor.submit(task)
+            except ExecutorBusy:
+                message.edit_text(
+                    "⚠️ Sono sovraccarico in questo momento, riprova tra poco.."
+                )
+                return False
+
+            return True
+
+        return wrapper
+
+    return decorator
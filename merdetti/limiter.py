@@ -0,0 +1,163 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND = 0, 1
+
+PORTAL_RATE_LIMIT = float(os.getenv("PORTAL_RATE_LIMIT") or 20)
+PORTAL_MAX_INFLIGHT = int(os.getenv("PORTAL_MAX_INFLIGHT") or 16)
+# portal commands per minute and burst of a single user
+USER_RATE_LIMIT = float(os.getenv("USER_RATE_LIMIT") or 6)
+USER_RATE_BURST = int(os.getenv("USER_RATE_BURST") or 4)
+USER_RATE_SIZE = 10000
+
+_local = threading.local()
+
+
+@contextmanager
+def priority(level: int):
+    previous = current_priority()
+    _local.priority = level
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def current_priority() -> int:
+    return getattr(_local, "priority", PRIORITY_INTERACTIVE)
+
+
+def run_with_priority(level: int, func, *args, **kwargs):
+    with priority(level):
+        return func(*args, **kwargs)
+
+
+class RateLimiter:
+    def __init__(self, rate: float, max_inflight: int) -> None:
+        self._rate = rate
+        self._burst = max(1.0, rate)
+        self._tokens = self._burst
+        self._updated = time.monotonic()
+        self._max_inflight = max_inflight
+        self._inflight = 0
+        self._waiting = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            self._burst, self._tokens + (now - self._updated) * self._rate
+        )
+        self._updated = now
+
+    def _wait_time(self):
+        # None means waiting for a release, otherwise for the next token
+        if self._max_inflight > 0 and self._inflight >= self._max_inflight:
+            return None
+
+        if self._rate <= 0:
+            return 0
+
+        self._refill()
+        if self._tokens >= 1:
+            return 0
+
+        return (1 - self._tokens) / self._rate
+
+    def acquire(self, level: int = None) -> None:
+        if level is None:
+            level = current_priority()
+
+        ticket = (level, next(self._counter))
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    wait = self._wait_time() if self._waiting[0] == ticket else None
+                    if wait == 0:
+                        break
+
+                    self._condition.wait(wait)
+            except BaseException:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+                raise
+
+            heapq.heappop(self._waiting)
+            if self._rate > 0:
+                self._tokens -= 1
+            self._inflight += 1
+
+            # the next waiter in line may be able to go as well
+            self._condition.notify_all()
+
+    def release(self) -> None:
+        with self._condition:
+            self._inflight -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, level: int = None):
+        self.acquire(level)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+
+portal_limiter = RateLimiter(PORTAL_RATE_LIMIT, PORTAL_MAX_INFLIGHT)
+
+
+# A token bucket for every user, that rejects instead of waiting: a noisy user
+# is told to slow down and does not take the portal budget of the others.
+class UserRateLimiter:
+    def __init__(
+        self,
+        rate: float = USER_RATE_LIMIT / 60,
+        burst: int = USER_RATE_BURST,
+        size: int = USER_RATE_SIZE,
+    ) -> None:
+        self._rate = rate
+        self._burst = burst
+        self._size = size
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, user_id: int) -> bool:
+        if self._rate <= 0:
+            return True
+
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated = self._buckets.get(user_id, (self._burst, now))
+            tokens = min(self._burst, tokens + (now - updated) * self._rate)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            # a forgotten user has a full bucket, like a new one
+            self._buckets[user_id] = (tokens, now)
+            self._buckets.move_to_end(user_id)
+            while len(self._buckets) > self._size:
+                self._buckets.popitem(last=False)
+
+            return allowed
+
+
+user_limiter = UserRateLimiter()
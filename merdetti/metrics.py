@@ -0,0 +1,89 @@
+import logging
+import os
+
+from prometheus_client import Gauge, Histogram, start_http_server
+from telegram.utils.request import Request
+
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 0)
+METRICS_ADDRESS = os.getenv("METRICS_ADDRESS") or "0.0.0.0"
+
+logger = logging.getLogger(__name__)
+
+PORTAL_SECONDS = Histogram(
+    "merdetti_portal_seconds",
+    "Duration of the calls to the Zucchetti portal",
+    ["operation", "outcome"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32),
+)
+HANDLER_SECONDS = Histogram(
+    "merdetti_handler_seconds",
+    "Time spent by a dispatcher worker in a handler",
+    ["handler"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8),
+)
+REMINDER_LATENESS_SECONDS = Histogram(
+    "merdetti_reminder_lateness_seconds",
+    "Delay between the scheduled minute of a reminder and its execution",
+    buckets=(1, 5, 15, 30, 45, 60, 90, 120, 300, 600),
+)
+REMINDER_QUEUED_SECONDS = Histogram(
+    "merdetti_reminder_queued_seconds",
+    "Delay of a reminder past the time it was spread to within its minute",
+    buckets=(0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600),
+)
+TELEGRAM_SECONDS = Histogram(
+    "merdetti_telegram_seconds",
+    "Duration of the calls to the Telegram Bot API",
+    ["method"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8),
+)
+DISPATCHER_QUEUE = Gauge(
+    "merdetti_dispatcher_queue_depth", "Updates waiting for the dispatcher"
+)
+PORTAL_PENDING = Gauge(
+    "merdetti_portal_pending_tasks", "Portal tasks running or waiting for a worker"
+)
+BACKGROUND_PENDING = Gauge(
+    "merdetti_background_pending_tasks",
+    "Reminder tasks running or waiting for a worker",
+)
+PORTAL_BREAKER_OPEN = Gauge(
+    "merdetti_portal_breaker_open",
+    "Whether the circuit breaker of a portal refuses the calls",
+    ["base_url"],
+)
+PORTAL_TIMEOUT = Gauge(
+    "merdetti_portal_timeout_seconds",
+    "Current timeout of the calls to a portal",
+    ["base_url"],
+)
+
+
+class TimedRequest(Request):
+    def post(self, url: str, data, timeout: float = None):
+        with TELEGRAM_SECONDS.labels(url.rsplit("/", 1)[-1]).time():
+            return super().post(url, data, timeout=timeout)
+
+
+def timed_handler(name: str, func):
+    histogram = HANDLER_SECONDS.labels(name)
+
+    def wrapper(*args, **kwargs):
+        with histogram.time():
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def start(
+    dispatcher, portal_executor, background_executor, port: int = METRICS_PORT
+) -> None:
+    DISPATCHER_QUEUE.set_function(dispatcher.update_queue.qsize)
+    PORTAL_PENDING.set_function(lambda: portal_executor.pending)
+    BACKGROUND_PENDING.set_function(lambda: background_executor.pending)
+
+    if not port:
+        return
+
+    start_http_server(port, addr=METRICS_ADDRESS)
+    logger.info("Serving metrics on %s:%d/metrics", METRICS_ADDRESS, port)
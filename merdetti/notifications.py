@@ -1,15 +1,14 @@
 import logging
 import re
-from datetime import datetime
 from typing import Tuple
 
-from dateutil import tz
 from telegram import Update
-from telegram.ext import CallbackContext, CallbackQueryHandler
+from telegram.ext import CallbackContext
 from telegram.ext.updater import Updater
 
 from .constants import *
-from .helpers import callback, callback_pattern, logged_user, make_keyboard
+from .helpers import callback, logged_user, make_keyboard, split_callback_data
+from .scheduler import ReminderScheduler
 
 (
     NOTIFICATION_EXIT_CALLBACK,
@@ -44,12 +43,13 @@ DAYS_OF_WEEK = {
     5: "sabato",
     6: "domenica",
 }
+DAY_INDEXES = {name: index for index, name in DAYS_OF_WEEK.items()}
 
 STAMP_TYPE, WHEN_DAYS, WHEN_TIME = "stamp_type", "when_days", "when_time"
 
 logger = logging.getLogger(__name__)
 
-notification_jobs = dict()
+reminder_scheduler = ReminderScheduler()
 
 
 @logged_user
@@ -122,9 +122,9 @@ def remove_action(update: Update, context: CallbackContext):
         )
         return
 
-    notification_jobs[
+    reminder_scheduler.remove(
         (update.effective_user.id, notification_key(stamp_reminders[index]))
-    ].schedule_removal()
+    )
     context.user_data[STAMP_REMINDERS].remove(stamp_reminders[index])
 
     keyboard = make_keyboard(("Indietro", NOTIFICATION_BACK_CALLBACK), context)
@@ -152,19 +152,16 @@ def add_callback(update: Update, context: CallbackContext):
 def choose_days(update: Update, context: CallbackContext):
     tmp_notification = context.user_data[TMP_NOTIFICATION]
 
-    callback_data = update.callback_query.data[: update.callback_query.data.index("#")]
+    callback_data, _ = split_callback_data(update.callback_query.data)
     if callback_data == REMIND_ENTER_CALLBACK:
         tmp_notification[STAMP_TYPE] = "entrata"
         tmp_notification[WHEN_TIME] = "9:15"
     elif callback_data == REMIND_EXIT_CALLBACK:
         tmp_notification[STAMP_TYPE] = "uscita"
         tmp_notification[WHEN_TIME] = "18:15"
-    elif callback_data in DAYS_OF_WEEK.values():
+    elif callback_data in DAY_INDEXES:
         when_days = tmp_notification[WHEN_DAYS]
-        for index, name in DAYS_OF_WEEK.items():
-            if name == callback_data:
-                current = index
-                break
+        current = DAY_INDEXES[callback_data]
 
         if current in when_days:
             when_days.remove(current)
@@ -191,122 +188,107 @@ def choose_days(update: Update, context: CallbackContext):
     )
 
 
-def choose_time_wrapper(stamp_reminder_callback):
-    @callback
-    def choose_time(update: Update, context: CallbackContext):
-        keyboard = make_keyboard(("Indietro", NOTIFICATION_BACK_CALLBACK), context)
-
-        if update.callback_query:
-            message = (
-                "Inserisci l'orario in cui inviare la notifica, nel formato HH:MM 🕐"
-            )
-            update.callback_query.edit_message_text(text=message, reply_markup=keyboard)
-
-            context.user_data[INPUT_KIND] = KIND_NOTIFICATION_TIME
-            return
-
-        input_time = update.message.text.strip()
-        if re.match(r"^(0[0-9]|1[0-9]|2[0-3]):[0-5][0-9]$", input_time):
-            context.user_data[TMP_NOTIFICATION][WHEN_TIME] = input_time
-
-            user_id = update.effective_user.id
-            schedule_data = context.user_data[TMP_NOTIFICATION]
-            del context.user_data[TMP_NOTIFICATION]
-
-            reminders = context.user_data.get(STAMP_REMINDERS) or []
-            reminders.append(schedule_data)
-            context.user_data[STAMP_REMINDERS] = reminders
-
-            job = context.job_queue.run_daily(
-                stamp_reminder_callback,
-                time=job_time(schedule_data[WHEN_TIME]),
-                days=schedule_data[WHEN_DAYS],
-                context={
-                    "bot": context.bot,
-                    "user_id": user_id,
-                    "user_data": context.user_data,
-                    "schedule_data": schedule_data,
-                },
-            )
-
-            logger.info(
-                "Added reminder for user %s (%s): %s",
-                user_id,
-                update.effective_user.first_name,
-                schedule_data,
-            )
-            notification_jobs[(user_id, notification_key(schedule_data))] = job
-
-            message = "Notifica aggiunta! ✅"
-            update.message.reply_text(text=message, reply_markup=keyboard)
-
-            context.user_data[INPUT_KIND] = None
-            return
-
-        message = "L'orario deve essere nel formato HH:MM ⚠️"
+@callback
+def choose_time(update: Update, context: CallbackContext):
+    keyboard = make_keyboard(("Indietro", NOTIFICATION_BACK_CALLBACK), context)
+
+    if update.callback_query:
+        message = "Inserisci l'orario in cui inviare la notifica, nel formato HH:MM 🕐"
+        update.callback_query.edit_message_text(text=message, reply_markup=keyboard)
+
+        context.user_data[INPUT_KIND] = KIND_NOTIFICATION_TIME
+        return
+
+    input_time = update.message.text.strip()
+    if re.match(r"^(0[0-9]|1[0-9]|2[0-3]):[0-5][0-9]$", input_time):
+        context.user_data[TMP_NOTIFICATION][WHEN_TIME] = input_time
+
+        user_id = update.effective_user.id
+        schedule_data = context.user_data[TMP_NOTIFICATION]
+        del context.user_data[TMP_NOTIFICATION]
+
+        reminders = context.user_data.get(STAMP_REMINDERS) or []
+        reminders.append(schedule_data)
+        context.user_data[STAMP_REMINDERS] = reminders
+
+        schedule_reminder(context.bot, user_id, context.user_data, schedule_data)
+
+        logger.info(
+            "Added reminder for user %s (%s): %s",
+            user_id,
+            update.effective_user.first_name,
+            schedule_data,
+        )
+
+        message = "Notifica aggiunta! ✅"
         update.message.reply_text(text=message, reply_markup=keyboard)
 
-    return choose_time
+        context.user_data[INPUT_KIND] = None
+        return
+
+    message = "L'orario deve essere nel formato HH:MM ⚠️"
+    update.message.reply_text(text=message, reply_markup=keyboard)
+
+
+def schedule_reminder(bot, user_id, user_data, schedule_data):
+    reminder_scheduler.add(
+        (user_id, notification_key(schedule_data)),
+        schedule_data[WHEN_DAYS],
+        schedule_data[WHEN_TIME],
+        {
+            "bot": bot,
+            "user_id": user_id,
+            "user_data": user_data,
+            "schedule_data": schedule_data,
+        },
+    )
 
 
-def setup_scheduler(updater: Updater, stamp_reminder_callback):
-    for user_id, user_values in updater.dispatcher.user_data.items():
+def setup_scheduler(
+    updater: Updater,
+    stamp_reminder_callback,
+    submit=None,
+    prewarm_callback=None,
+    lease=None,
+):
+    for user_id, user_values in updater.dispatcher.user_data.all_items():
         if STAMP_REMINDERS in user_values:
             for schedule_data in user_values[STAMP_REMINDERS]:
                 try:
-                    print(job_time(schedule_data[WHEN_TIME]))
-                    job = updater.job_queue.run_daily(
-                        stamp_reminder_callback,
-                        time=job_time(schedule_data[WHEN_TIME]),
-                        days=schedule_data[WHEN_DAYS],
-                        context={
-                            "bot": updater.bot,
-                            "user_id": user_id,
-                            "user_data": user_values,
-                            "schedule_data": schedule_data,
-                        },
-                    )
+                    schedule_reminder(updater.bot, user_id, user_values, schedule_data)
 
-                    logger.info("Setup reminder for user %s: %s", user_id, schedule_data)
-
-                    notification_jobs[(user_id, notification_key(schedule_data))] = job
+                    logger.debug(
+                        "Setup reminder for user %s: %s", user_id, schedule_data
+                    )
                 except Exception as ex:
                     logger.error("Failed to add reminder for user %s: %s", user_id, ex)
 
+    logger.info("Scheduled %d reminders", len(reminder_scheduler))
+
+    reminder_scheduler.start(
+        updater.job_queue,
+        stamp_reminder_callback,
+        submit or updater.dispatcher.run_async,
+        prewarm=prewarm_callback,
+        lease=lease,
+    )
 
-def handlers(stamp_reminder_callback):
-    choose_time_handler = choose_time_wrapper(stamp_reminder_callback)
 
+def callback_routes():
     return [
-        CallbackQueryHandler(
-            exit_callback, pattern=callback_pattern(NOTIFICATION_EXIT_CALLBACK)
-        ),
-        CallbackQueryHandler(
-            back_callback, pattern=callback_pattern(NOTIFICATION_BACK_CALLBACK)
-        ),
-        CallbackQueryHandler(
-            remove_callback, pattern=callback_pattern(NOTIFICATION_REMOVE_CALLBACK)
-        ),
-        CallbackQueryHandler(
-            add_callback, pattern=callback_pattern(NOTIFICATION_ADD_CALLBACK)
-        ),
-        CallbackQueryHandler(
-            choose_days,
-            pattern=callback_pattern(
-                f'({REMIND_ENTER_CALLBACK}|{REMIND_EXIT_CALLBACK}|{"|".join(DAYS_OF_WEEK.values())})'
-            ),
-        ),
-        CallbackQueryHandler(
-            choose_time_handler, pattern=callback_pattern(CHOOSE_TIME_CALLBACK)
-        ),
-    ]
+        (NOTIFICATION_EXIT_CALLBACK, exit_callback),
+        (NOTIFICATION_BACK_CALLBACK, back_callback),
+        (NOTIFICATION_REMOVE_CALLBACK, remove_callback),
+        (NOTIFICATION_ADD_CALLBACK, add_callback),
+        (REMIND_ENTER_CALLBACK, choose_days),
+        (REMIND_EXIT_CALLBACK, choose_days),
+        (CHOOSE_TIME_CALLBACK, choose_time),
+    ] + [(day, choose_days) for day in DAYS_OF_WEEK.values()]
 
 
-def user_input_handlers(stamp_reminder_callback):
-    choose_time_handler = choose_time_wrapper(stamp_reminder_callback)
-
+def user_input_handlers():
     return [
-        (KIND_NOTIFICATION_TIME, choose_time_handler),
+        (KIND_NOTIFICATION_TIME, choose_time),
         (KIND_NOTIFICATION_INDEX, remove_action),
     ]
 
@@ -317,12 +299,3 @@ def notification_key(notification: dict) -> Tuple:
         ",".join([str(d) for d in notification[WHEN_DAYS]]),
         notification[WHEN_TIME],
     )
-
-
-def job_time(time):
-    return (
-        datetime.strptime(time, "%H:%M")
-        .replace(tzinfo=tz.tzlocal())
-        .astimezone(tz.UTC)
-        .time()
-    )
@@ -0,0 +1,359 @@
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from telegram.ext import BasePersistence
+
+FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL") or 5)
+# seconds a write waits for another process holding the database
+BUSY_TIMEOUT = 30
+MIGRATED_KEY = "migrated"
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS chat_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS store (key TEXT PRIMARY KEY, data BLOB NOT NULL);
+"""
+
+
+def dump(value) -> bytes:
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def digest(blob: bytes) -> bytes:
+    return hashlib.blake2b(blob, digest_size=16).digest()
+
+
+# The users are read from the database on first access. Like a plain dict it
+# only iterates over the users loaded so far, so the dispatcher never touches
+# the users that did not interact with the bot: all_keys() and all_items() walk
+# every stored user.
+class LazyUserData(defaultdict):
+    def __init__(self, loader=None, user_ids=()) -> None:
+        super().__init__(dict)
+        self._loader = loader
+        self._pending = set(user_ids)
+        self._lock = threading.Lock()
+
+    def __missing__(self, user_id):
+        with self._lock:
+            if dict.__contains__(self, user_id):
+                return dict.__getitem__(self, user_id)
+
+            if user_id in self._pending:
+                data = self._loader(user_id)
+                self._pending.discard(user_id)
+            else:
+                data = dict()
+
+            self[user_id] = data
+            return data
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self._pending or dict.__contains__(self, user_id)
+
+    def __copy__(self):
+        clone = LazyUserData(self._loader, self._pending)
+        dict.update(clone, self)
+        return clone
+
+    copy = __copy__
+
+    def all_keys(self) -> list:
+        return list(self._pending | set(self.keys()))
+
+    def all_items(self):
+        for user_id in self.all_keys():
+            yield user_id, self[user_id]
+
+
+class SQLitePersistence(BasePersistence):
+    def __init__(
+        self,
+        filename: str,
+        migrate_from: str = None,
+        transient_keys=(),
+        flush_interval: float = FLUSH_INTERVAL,
+        owns_user=None,
+        bot_data_key: str = "bot_data",
+    ) -> None:
+        # the bot keeps nothing in chat_data: storing it wrote an empty row for
+        # every private chat and loaded them all at startup
+        super().__init__(
+            store_user_data=True, store_chat_data=False, store_bot_data=True
+        )
+        self.filename = filename
+        self.migrate_from = migrate_from
+        self.transient_keys = frozenset(transient_keys)
+        self.flush_interval = flush_interval
+        # processes sharing the database load only the users they serve and
+        # keep their own bot_data
+        self.owns_user = owns_user
+        self.bot_data_key = bot_data_key
+
+        self._connection = None
+        self._lock = threading.RLock()
+        self._digests = dict()
+        self._conversations = dict()
+
+        self._dirty = dict()
+        self._stats = {
+            "writes": 0,
+            "writes_avoided": 0,
+            "flushes": 0,
+            "rows_flushed": 0,
+            "last_flush_seconds": 0.0,
+            "total_flush_seconds": 0.0,
+        }
+        self._writer = None
+        self._stop = threading.Event()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._connection is None:
+                self._connection = self._connect()
+
+            return self._connection
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(
+            self.filename,
+            timeout=BUSY_TIMEOUT,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+
+        if self.migrate_from and os.path.exists(self.migrate_from):
+            self._migrate(connection)
+
+        return connection
+
+    def _migrate(self, connection: sqlite3.Connection) -> None:
+        # the data is committed with a marker: a migration that failed or was
+        # interrupted is done again on the next start, until the marker is there
+        rows = connection.execute(
+            "SELECT 1 FROM store WHERE key = ?", (MIGRATED_KEY,)
+        ).fetchall()
+        if not rows:
+            self._migrate_data(connection)
+
+        os.rename(self.migrate_from, self.migrate_from + ".migrated")
+
+    def _migrate_data(self, connection: sqlite3.Connection) -> None:
+        with open(self.migrate_from, "rb") as file:
+            data = pickle.load(file)
+
+        with connection:
+            connection.execute("BEGIN")
+            connection.executemany(
+                "INSERT OR REPLACE INTO user_data VALUES (?, ?)",
+                [
+                    (k, dump(self._persisted(v)))
+                    for k, v in (data.get("user_data") or {}).items()
+                ],
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO store VALUES ('bot_data', ?)",
+                (dump(data.get("bot_data") or {}),),
+            )
+            for name, conversation in (data.get("conversations") or {}).items():
+                connection.execute(
+                    "INSERT OR REPLACE INTO store VALUES (?, ?)",
+                    (f"conversation:{name}", dump(conversation)),
+                )
+            connection.execute(
+                "INSERT OR REPLACE INTO store VALUES (?, ?)",
+                (MIGRATED_KEY, dump(self.migrate_from)),
+            )
+
+        logger.info(
+            "Migrated %d users from %s to %s",
+            len(data.get("user_data") or {}),
+            self.migrate_from,
+            self.filename,
+        )
+
+    def _read(self, query: str, params=()):
+        with self._lock:
+            return self.connection.execute(query, params).fetchall()
+
+    def _fields_digest(self, data) -> dict:
+        if not isinstance(data, dict):
+            return {None: digest(dump(data))}
+
+        return {
+            field: digest(dump(value))
+            for field, value in data.items()
+            if field not in self.transient_keys
+        }
+
+    def _persisted(self, data):
+        if not isinstance(data, dict):
+            return data
+
+        return {k: v for k, v in data.items() if k not in self.transient_keys}
+
+    def _write(self, table: str, key, data) -> None:
+        fields = self._fields_digest(data)
+
+        with self._lock:
+            previous = self._digests.get((table, key))
+            if previous == fields:
+                self._stats["writes_avoided"] += 1
+                return
+
+            if previous is not None:
+                changed = {
+                    f
+                    for f in fields.keys() | previous.keys()
+                    if fields.get(f) != previous.get(f)
+                }
+                logger.debug("%s %s changed fields: %s", table, key, changed)
+
+            data = self._persisted(data)
+
+            self._digests[(table, key)] = fields
+            self._dirty[(table, key)] = dump(data)
+            self._stats["writes"] += 1
+
+        if self.flush_interval <= 0:
+            self._flush_dirty()
+        else:
+            self._start_writer()
+
+    def _load(self, table: str, key, blob: bytes):
+        data = pickle.loads(blob)
+        self._digests[(table, key)] = self._fields_digest(data)
+        return data
+
+    def _start_writer(self) -> None:
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._writer_loop, name="persistence_writer", daemon=True
+                )
+                self._writer.start()
+
+    def _writer_loop(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self._flush_dirty()
+            except Exception:
+                logger.exception("Failed to flush the persistence")
+
+    def _flush_dirty(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+
+            dirty, self._dirty = self._dirty, dict()
+
+            started = time.monotonic()
+            try:
+                with self.connection:
+                    self.connection.execute("BEGIN")
+                    for (table, key), blob in dirty.items():
+                        self.connection.execute(
+                            f"INSERT OR REPLACE INTO {table} VALUES (?, ?)",
+                            (key, blob),
+                        )
+            except Exception:
+                # the digests already match these rows, so the same data would
+                # never be written again: they wait for the next flush instead
+                dirty.update(self._dirty)
+                self._dirty = dirty
+                raise
+            elapsed = time.monotonic() - started
+
+            self._stats["flushes"] += 1
+            self._stats["rows_flushed"] += len(dirty)
+            self._stats["last_flush_seconds"] = elapsed
+            self._stats["total_flush_seconds"] += elapsed
+
+        logger.debug("Flushed %d rows in %.3fs", len(dirty), elapsed)
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, pending=len(self._dirty))
+
+    def _load_user(self, user_id: int) -> dict:
+        rows = self._read("SELECT data FROM user_data WHERE id = ?", (user_id,))
+        if not rows:
+            return dict()
+
+        return self.insert_bot(self._load("user_data", user_id, rows[0][0]))
+
+    def user_ids(self) -> list:
+        with self._lock:
+            user_ids = {row[0] for row in self._read("SELECT id FROM user_data")}
+            user_ids.update(key for table, key in self._dirty if table == "user_data")
+
+        return list(user_ids)
+
+    def get_user_data(self) -> LazyUserData:
+        user_ids = self.user_ids()
+        if self.owns_user:
+            user_ids = [user_id for user_id in user_ids if self.owns_user(user_id)]
+
+        return LazyUserData(self._load_user, user_ids)
+
+    def get_chat_data(self) -> defaultdict:
+        rows = self._read("SELECT id, data FROM chat_data")
+        return defaultdict(
+            dict, {key: self._load("chat_data", key, blob) for key, blob in rows}
+        )
+
+    def get_bot_data(self) -> dict:
+        key = self.bot_data_key
+        rows = self._read("SELECT data FROM store WHERE key = ?", (key,))
+        return self._load("store", key, rows[0][0]) if rows else dict()
+
+    def get_conversations(self, name: str) -> dict:
+        key = f"conversation:{name}"
+        if name not in self._conversations:
+            rows = self._read("SELECT data FROM store WHERE key = ?", (key,))
+            self._conversations[name] = (
+                self._load("store", key, rows[0][0]) if rows else dict()
+            )
+
+        return self._conversations[name].copy()
+
+    def update_conversation(self, name: str, key, new_state) -> None:
+        conversation = self._conversations.setdefault(name, dict())
+        if conversation.get(key) == new_state:
+            return
+
+        conversation[key] = new_state
+        self._write("store", f"conversation:{name}", conversation)
+
+    def update_user_data(self, user_id: int, data: dict) -> None:
+        self._write("user_data", user_id, data)
+
+    def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._write("chat_data", chat_id, data)
+
+    def update_bot_data(self, data: dict) -> None:
+        self._write("store", self.bot_data_key, data)
+
+    def flush(self) -> None:
+        self._stop.set()
+        self._flush_dirty()
+
+        logger.info("Persistence stats: %s", self.stats)
+
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,49 @@
+from telegram import Update
+from telegram.ext import CallbackContext, CallbackQueryHandler, Filters, MessageHandler
+
+from .constants import *
+from .helpers import split_callback_data
+from .metrics import timed_handler
+
+
+# Every update is routed with a single dict lookup, instead of trying each
+# handler pattern in turn: callback queries by the action before the "#" of
+# their data, text messages by the input kind the user is expected to send.
+class Router:
+    def __init__(self) -> None:
+        self._callbacks = dict()
+        self._inputs = dict()
+
+    def add_callbacks(self, routes) -> None:
+        for action, func in routes:
+            if action in self._callbacks:
+                raise ValueError(f"Callback action {action} already routed")
+            self._callbacks[action] = timed_handler(action, func)
+
+    def add_inputs(self, routes) -> None:
+        for input_kind, func in routes:
+            if input_kind in self._inputs:
+                raise ValueError(f"Input kind {input_kind} already routed")
+            self._inputs[input_kind] = timed_handler(input_kind, func)
+
+    def route_callback(self, update: Update, context: CallbackContext):
+        action, _ = split_callback_data(update.callback_query.data)
+        func = self._callbacks.get(action)
+
+        if func is None:
+            update.callback_query.answer()
+            return
+
+        return func(update, context)
+
+    def route_input(self, update: Update, context: CallbackContext):
+        func = self._inputs.get(context.user_data.get(INPUT_KIND))
+
+        if func is not None:
+            return func(update, context)
+
+    def handlers(self) -> list:
+        return [
+            CallbackQueryHandler(self.route_callback),
+            MessageHandler(Filters.text & ~Filters.command, self.route_input),
+        ]
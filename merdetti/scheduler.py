@@ -0,0 +1,245 @@
+import fcntl
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from dateutil import tz
+from telegram.ext import CallbackContext, JobQueue
+
+from .metrics import REMINDER_LATENESS_SECONDS, REMINDER_QUEUED_SECONDS
+
+TICK_INTERVAL = 60
+MAX_CATCH_UP = 60
+REMINDER_JITTER = float(os.getenv("REMINDER_JITTER") or 45)
+REMINDER_PREWARM = int(os.getenv("REMINDER_PREWARM") or 0)
+
+logger = logging.getLogger(__name__)
+
+
+def slot(weekday: int, when_time: str):
+    hours, minutes = when_time.split(":")
+    return (weekday, int(hours) * 60 + int(minutes))
+
+
+class DelayedRunner:
+    def __init__(self) -> None:
+        self._queue = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def run_later(self, delay: float, func, *args) -> None:
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="delayed_runner", daemon=True
+                )
+                self._thread.start()
+
+            heapq.heappush(
+                self._queue, (time.monotonic() + delay, next(self._counter), func, args)
+            )
+            self._condition.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._queue or self._queue[0][0] > time.monotonic():
+                    timeout = (
+                        self._queue[0][0] - time.monotonic() if self._queue else None
+                    )
+                    self._condition.wait(timeout)
+
+                _, _, func, args = heapq.heappop(self._queue)
+
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("Delayed function failed")
+
+
+# An exclusive lock on a file lets a single process run a set of reminders: the
+# others stand by and take over when it exits. The file keeps the last minute
+# run, so the process taking over goes on from there instead of running the
+# same minutes again.
+class ReminderLease:
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._file = None
+
+    def acquire(self) -> bool:
+        if self._file:
+            return True
+
+        file = open(self._path, "a+")
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return False
+
+        self._file = file
+        logger.info("Acquired the reminders lease %s", self._path)
+        return True
+
+    def last_minute(self):
+        self._file.seek(0)
+        content = self._file.read().strip()
+
+        return datetime.fromisoformat(content) if content else None
+
+    def mark(self, minute: datetime) -> None:
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(minute.isoformat())
+        self._file.flush()
+
+
+class ReminderScheduler:
+    def __init__(
+        self, jitter: float = REMINDER_JITTER, prewarm_minutes: int = REMINDER_PREWARM
+    ) -> None:
+        self._slots = defaultdict(dict)
+        self._entries = dict()
+        self._lock = threading.Lock()
+        self._callback = None
+        self._prewarm = None
+        self._submit = None
+        self._lease = None
+        self._last_minute = None
+        self._jitter = jitter
+        self._prewarm_minutes = prewarm_minutes
+        self._runner = DelayedRunner()
+
+    def add(self, key, when_days, when_time, reminder) -> None:
+        slots = [slot(day, when_time) for day in when_days]
+
+        with self._lock:
+            self._remove(key)
+
+            for s in slots:
+                self._slots[s][key] = reminder
+            self._entries[key] = slots
+
+    def remove(self, key) -> None:
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key) -> None:
+        for s in self._entries.pop(key, []):
+            bucket = self._slots[s]
+            bucket.pop(key, None)
+            if not bucket:
+                del self._slots[s]
+
+    def due(self, minute: datetime) -> list:
+        with self._lock:
+            return list(
+                self._slots.get(slot(minute.weekday(), f"{minute:%H:%M}"), {}).values()
+            )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def prewarm_age(self) -> float:
+        # the oldest state a reminder can find when it fires after a pre-warm
+        if not self._prewarm_minutes:
+            return 0
+
+        return self._prewarm_minutes * 60 + self._jitter + TICK_INTERVAL
+
+    def start(
+        self, job_queue: JobQueue, callback, submit, prewarm=None, lease=None
+    ) -> None:
+        self._callback = callback
+        self._prewarm = prewarm
+        self._submit = submit
+        self._lease = lease
+
+        now = datetime.now()
+        first = TICK_INTERVAL - now.second - now.microsecond / 1e6 + 1
+        job_queue.run_repeating(
+            self._tick, interval=TICK_INTERVAL, first=first, name="reminders"
+        )
+
+    def _due_minutes(self, now: datetime) -> list:
+        # the wall clock minutes are walked in local time: a minute skipped by a
+        # late tick or by a forward DST change is caught up, a minute repeated
+        # by a backward DST change is not run twice
+        minute = now.replace(second=0, microsecond=0)
+        if self._last_minute is None:
+            minutes = [minute]
+        else:
+            minutes = []
+            current = self._last_minute + timedelta(minutes=1)
+            while current <= minute and len(minutes) < MAX_CATCH_UP:
+                minutes.append(current)
+                current += timedelta(minutes=1)
+
+        if minutes:
+            self._last_minute = minutes[-1]
+
+        return minutes
+
+    def _tick(self, context: CallbackContext) -> None:
+        now = datetime.now(tz.tzlocal()).replace(tzinfo=None)
+
+        if self._lease:
+            if not self._lease.acquire():
+                return
+
+            if self._last_minute is None:
+                self._last_minute = self._resumed_minute(now)
+
+        minutes = self._due_minutes(now)
+        for minute in minutes:
+            for reminder in self.due(minute):
+                # reminders of the same minute are spread over it, so they do not
+                # all hit the portal at the same second
+                delay = random.uniform(0, self._jitter)
+                self._runner.run_later(
+                    delay, self._submit, self._fire, minute, delay, reminder
+                )
+
+            if self._prewarm and self._prewarm_minutes:
+                self._schedule_prewarm(
+                    self.due(minute + timedelta(minutes=self._prewarm_minutes))
+                )
+
+        if self._lease and minutes:
+            self._lease.mark(minutes[-1])
+
+    def _resumed_minute(self, now: datetime):
+        last_minute = self._lease.last_minute()
+        if last_minute is None:
+            return None
+
+        # the minutes missed while no process held the lease are caught up
+        oldest = now.replace(second=0, microsecond=0) - timedelta(minutes=MAX_CATCH_UP)
+        return max(last_minute, oldest)
+
+    def _fire(self, minute: datetime, delay: float, reminder) -> None:
+        # the lateness seen by the user includes the jitter, the queued time
+        # only what the bot added to it
+        now = datetime.now(tz.tzlocal()).replace(tzinfo=None)
+        lateness = (now - minute).total_seconds()
+        REMINDER_LATENESS_SECONDS.observe(lateness)
+        REMINDER_QUEUED_SECONDS.observe(max(lateness - delay, 0))
+
+        self._callback(reminder)
+
+    def _schedule_prewarm(self, reminders: list) -> None:
+        # the reminders due in the lead time are pre-warmed at even intervals
+        # over it, ending a tick before they fire
+        span = max(self._prewarm_minutes * 60 - TICK_INTERVAL, 0)
+        for index, reminder in enumerate(reminders):
+            self._runner.run_later(
+                span * index / len(reminders), self._submit, self._prewarm, reminder
+            )
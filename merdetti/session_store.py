@@ -0,0 +1,63 @@
+import json
+import logging
+import os
+import threading
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from .limiter import RateLimiter
+
+SESSION_RESTORE_RATE = float(os.getenv("SESSION_RESTORE_RATE") or 5)
+
+logger = logging.getLogger(__name__)
+
+
+# One file per user with its credentials and the cookies of the portal session,
+# encrypted with the key given in the environment. The sessions are restored on
+# first use; the restored ones whose portal session expired during a restart
+# log in again at a limited rate, so they do not log in all together.
+class SessionStore:
+    def __init__(
+        self, directory: str, key: str, restore_rate: float = SESSION_RESTORE_RATE
+    ) -> None:
+        self._directory = directory
+        self._fernet = Fernet(key)
+        self.login_limiter = RateLimiter(restore_rate, max(1, int(restore_rate)))
+
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def _path(self, user_id: int) -> str:
+        return os.path.join(self._directory, f"{user_id}.session")
+
+    def exists(self, user_id: int) -> bool:
+        return os.path.exists(self._path(user_id))
+
+    def load(self, user_id: int):
+        try:
+            with open(self._path(user_id), "rb") as file:
+                token = file.read()
+        except FileNotFoundError:
+            return None
+
+        try:
+            return json.loads(self._fernet.decrypt(token))
+        except (InvalidToken, ValueError):
+            logger.warning("Discarding unreadable session of user %s", user_id)
+            return None
+
+    def save(self, user_id: int, state: dict) -> None:
+        path = self._path(user_id)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        token = self._fernet.encrypt(json.dumps(state).encode())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as file:
+            file.write(token)
+
+        os.replace(tmp_path, path)
+
+    def delete(self, user_id: int) -> None:
+        try:
+            os.remove(self._path(user_id))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,188 @@
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+
+from telegram import Bot, Update
+from telegram.ext import CallbackContext, TypeHandler, Updater
+
+from . import bot, metrics, webhook
+from .scheduler import ReminderLease
+from .startup import StartupProfile
+
+SHARDS = int(os.getenv("SHARDS") or 1)
+MONITOR_INTERVAL = 1
+STOP_TIMEOUT = 30
+
+logger = logging.getLogger(__name__)
+
+
+# Telegram user ids are spread evenly over their last digits, so the remainder
+# is enough to balance the users over the shards
+def shard_of(user_id: int, count: int) -> int:
+    return user_id % count
+
+
+class Shard:
+    def __init__(self, index: int, count: int, queue) -> None:
+        self.index = index
+        self.count = count
+        self.queue = queue
+
+    def owns(self, user_id: int) -> bool:
+        return shard_of(user_id, self.count) == self.index
+
+    @property
+    def bot_data_key(self) -> str:
+        # the first shard keeps the bot_data of the single process mode
+        return "bot_data" if self.index == 0 else f"bot_data:{self.index}"
+
+    def lease(self, data_dir: str) -> ReminderLease:
+        return ReminderLease(os.path.join(data_dir, f"reminders-{self.index}.lock"))
+
+    def start(self, updater: Updater) -> None:
+        # like the webhook mode, the updates received by the supervisor are put
+        # in the update queue of the dispatcher
+        updater.job_queue.start()
+        threading.Thread(
+            target=updater.dispatcher.start, name="dispatcher", daemon=True
+        ).start()
+        threading.Thread(
+            target=self._feed, args=(updater,), name="shard_feed", daemon=True
+        ).start()
+
+        # let Updater.idle() stop the dispatcher on shutdown
+        updater.running = True
+
+        logger.info("Shard %d of %d started", self.index, self.count)
+
+    def _feed(self, updater: Updater) -> None:
+        while True:
+            data = self.queue.get()
+            if data is None:
+                # the supervisor is stopping: stop as on a signal, so the
+                # persistence is flushed
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+
+            updater.update_queue.put(Update.de_json(json.loads(data), updater.bot))
+
+
+def _run_shard(shard: Shard, workers: int) -> None:
+    # the supervisor stops the shards, a Ctrl+C on the terminal reaches it only
+    os.setsid()
+
+    bot.run(StartupProfile(), workers=workers, shard=shard)
+
+
+class Supervisor:
+    def __init__(self, count: int, workers: int) -> None:
+        self._count = count
+        self._workers = workers
+        # a fresh interpreter for every shard, the supervisor has threads running
+        # when a shard is restarted
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = [self._context.Queue() for _ in range(count)]
+        self._processes = [None] * count
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def start(self) -> None:
+        with self._lock:
+            for index in range(self._count):
+                self._spawn(index)
+
+        threading.Thread(
+            target=self._monitor, name="shards_monitor", daemon=True
+        ).start()
+
+    def _spawn(self, index: int) -> None:
+        if self._processes[index]:
+            # a killed shard can hold the read lock of its queue forever, the
+            # updates still waiting in it are lost
+            self._queues[index].cancel_join_thread()
+            self._queues[index] = self._context.Queue()
+
+        process = self._context.Process(
+            target=_run_shard,
+            args=(Shard(index, self._count, self._queues[index]), self._workers),
+            name=f"shard-{index}",
+        )
+        process.start()
+        self._processes[index] = process
+
+    def _monitor(self) -> None:
+        while not self._stopping.wait(MONITOR_INTERVAL):
+            with self._lock:
+                if self._stopping.is_set():
+                    return
+
+                for index, process in enumerate(self._processes):
+                    if not process.is_alive():
+                        logger.warning(
+                            "Shard %d exited with code %s, restarting it",
+                            index,
+                            process.exitcode,
+                        )
+                        self._spawn(index)
+
+    def route(self, update: Update, context: CallbackContext) -> None:
+        user = update.effective_user
+        index = shard_of(user.id, self._count) if user else 0
+
+        self._queues[index].put(update.to_json())
+
+    def stop(self) -> None:
+        with self._lock:
+            self._stopping.set()
+
+        for queue in self._queues:
+            queue.put(None)
+
+        for index, process in enumerate(self._processes):
+            process.join(STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning("Shard %d did not stop, terminating it", index)
+                process.terminate()
+
+
+def run(
+    profile: StartupProfile = None,
+    webhook_config: dict = None,
+    workers=4,
+    count=SHARDS,
+) -> None:
+    profile = profile or StartupProfile()
+
+    # the database is created, or migrated from the pickle file, once before
+    # the shards open it
+    data_dir = os.getenv("DATA_DIR") or os.getcwd()
+    persistence = bot.make_persistence(data_dir)
+    persistence.connection
+    persistence.flush()
+
+    supervisor = Supervisor(count, workers)
+    supervisor.start()
+    profile.mark("shards")
+
+    updater = Updater(
+        bot=Bot(
+            os.getenv("TELEGRAM_TOKEN"),
+            base_url=os.getenv("TELEGRAM_BASE_URL"),
+            request=metrics.TimedRequest(),
+        ),
+        workers=0,
+    )
+    updater.dispatcher.add_handler(TypeHandler(Update, supervisor.route))
+
+    if webhook_config:
+        webhook.start(updater, **webhook_config)
+    else:
+        updater.start_polling()
+    profile.mark("polling")
+    profile.report()
+
+    updater.idle()
+    supervisor.stop()
@@ -0,0 +1,34 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class StartupProfile:
+    def __init__(self, started: float = None) -> None:
+        self._started = started if started is not None else time.monotonic()
+        self._phases = dict()
+        self._lock = threading.Lock()
+
+    def mark(self, phase: str) -> float:
+        with self._lock:
+            elapsed = time.monotonic() - self._started
+            self._phases.setdefault(phase, elapsed)
+            return self._phases[phase]
+
+    def marked(self, phase: str) -> bool:
+        return phase in self._phases
+
+    def phases(self) -> dict:
+        with self._lock:
+            return dict(self._phases)
+
+    def report(self, title: str = "Startup profile") -> None:
+        previous = 0.0
+        parts = []
+        for phase, elapsed in sorted(self.phases().items(), key=lambda p: p[1]):
+            parts.append(f"{phase} +{elapsed - previous:.3f}s (at {elapsed:.3f}s)")
+            previous = elapsed
+
+        logger.info("%s: %s", title, ", ".join(parts))
@@ -0,0 +1,90 @@
+import hmac
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+from telegram.ext import Updater
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+
+        if self.path.rstrip("/") != server.path:
+            self.send_error(404)
+            return
+
+        secret = self.headers.get(SECRET_HEADER) or ""
+        if server.secret and not hmac.compare_digest(secret, server.secret):
+            self.send_error(403)
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            update = Update.de_json(json.loads(self.rfile.read(length)), server.bot)
+        except ValueError:
+            self.send_error(400)
+            return
+
+        if update:
+            server.update_queue.put(update)
+
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, path, secret, bot, update_queue) -> None:
+        super().__init__(address, WebhookHandler)
+        self.path = "/" + path.strip("/")
+        self.secret = secret
+        self.bot = bot
+        self.update_queue = update_queue
+
+
+def start(
+    updater: Updater,
+    listen: str,
+    port: int,
+    path: str,
+    secret: str = None,
+    webhook_url: str = None,
+    max_connections: int = 40,
+) -> WebhookServer:
+    server = WebhookServer(
+        (listen, port), path, secret, updater.bot, updater.update_queue
+    )
+
+    if webhook_url:
+        updater.bot.set_webhook(
+            url=webhook_url.rstrip("/") + server.path,
+            max_connections=max_connections,
+            api_kwargs={"secret_token": secret} if secret else None,
+        )
+        logger.info("Webhook registered on %s", webhook_url)
+
+    updater.job_queue.start()
+    threading.Thread(
+        target=updater.dispatcher.start, name="dispatcher", daemon=True
+    ).start()
+    threading.Thread(target=server.serve_forever, name="webhook", daemon=True).start()
+
+    # let Updater.idle() stop the server and the dispatcher on shutdown
+    updater.httpd = server
+    updater.running = True
+
+    logger.info("Listening for updates on %s:%d%s", listen, port, server.path)
+
+    return server
@@ -1,20 +1,58 @@
+import logging
 import os
 import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import wraps
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from .breaker import breaker_for
+from .limiter import (
+    PORTAL_MAX_INFLIGHT,
+    current_priority,
+    portal_limiter,
+    run_with_priority,
+)
+from .metrics import PORTAL_SECONDS
 
 LOGIN_PATH = "/servlet/cp_login"
 SQL_DATA_PROVIDER_PATH = "/servlet/SQLDataProviderServer"
 STAMP_PATH = "/servlet/ushp_ftimbrus"
 M_CID_PATH = "/jsp/gsmd_container.jsp?containerCode=MYDESK"
 
+M_CID_PATTERN = "this.splinker10.m_cID='(.+?)';"
+M_CID_CHUNK_SIZE = 4096
+M_CID_OVERLAP = 256
+
 REQUEST_TIMEOUT = 16
+DEFAULT_INTERVAL = int(os.getenv("STAMPS_INTERVAL") or 12)
+STAMPS_WORKERS = int(os.getenv("STAMPS_WORKERS") or 8)
+STAMPS_CACHE_TTL = int(os.getenv("STAMPS_CACHE_TTL") or 120)
+STAMPS_CACHE_SIZE = int(os.getenv("STAMPS_CACHE_SIZE") or 10000)
+STAMP_DEDUP_WINDOW = int(os.getenv("STAMP_DEDUP_WINDOW") or 60)
+STAMPS_PAGE_SIZE = int(os.getenv("STAMPS_PAGE_SIZE") or 10)
+STAMP_TIME_PATTERN = re.compile(r"^\d{1,2}:\d{2}$")
 USER_AGENT = (
     "Mozilla/5.0 (X11; Fedora; Linux x86_64; rv:84.0) Gecko/20100101 Firefox/84.0"
 )
 
 
+logger = logging.getLogger(__name__)
+
+_stamps_executor = ThreadPoolExecutor(
+    max_workers=STAMPS_WORKERS, thread_name_prefix="stamps"
+)
+
+# the sessions of all the users share the keep-alive connections to the portal,
+# each one keeps only its own cookies; the limiter caps the requests in flight
+_adapter = HTTPAdapter(pool_maxsize=PORTAL_MAX_INFLIGHT)
+
+
 class ApiError(Exception):
     pass
 
@@ -23,26 +61,332 @@ class InvalidCredentials(Exception):
     pass
 
 
+class PortalUnavailable(ApiError):
+    pass
+
+
+class StampCache:
+    def __init__(self, ttl=STAMPS_CACHE_TTL, size=STAMPS_CACHE_SIZE) -> None:
+        self._ttl = ttl
+        self._size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _fresh_entry(self, key, max_age=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        now = time.monotonic()
+        if now > entry[2]:
+            del self._entries[key]
+            return None
+
+        # a prefetched entry is kept longer than the ttl, but only the callers
+        # that accept older stamps with max_age can read it
+        if now - entry[0] > (self._ttl if max_age is None else max_age):
+            return None
+
+        self._entries.move_to_end(key)
+        return entry
+
+    def get(self, key, max_age=None):
+        with self._lock:
+            entry = self._fresh_entry(key, max_age)
+            return list(entry[1]) if entry else None
+
+    def put(self, key, stamps, ttl=None) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._entries[key] = (now, list(stamps), now + (ttl or self._ttl))
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def append(self, key, stamp) -> None:
+        # only an already cached day can be completed, otherwise the other
+        # stamps of the day would be missing
+        with self._lock:
+            entry = self._fresh_entry(key, max_age=float("inf"))
+            if entry:
+                entry[1].append(stamp)
+
+    def invalidate(self, key) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+stamps_cache = StampCache()
+
+
+# Concurrent calls with the same key share the call of the first one and its
+# result, or its exception.
+class SingleFlight:
+    def __init__(self) -> None:
+        self._calls = dict()
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+
+        if not leader:
+            return call.result()
+
+        try:
+            result = func(*args)
+            call.set_result(result)
+            return result
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+def new_session() -> requests.Session:
+    session = requests.Session()
+    session.headers["User-Agent"] = USER_AGENT
+    session.mount("http://", _adapter)
+    session.mount("https://", _adapter)
+
+    return session
+
+
+def stamps_key(username, day):
+    return (username, day.strftime("%Y-%m-%d"))
+
+
+def session_expired(response) -> bool:
+    if LOGIN_PATH in response.url:
+        return True
+
+    if response.headers.get("JSURL-Message"):
+        return True
+
+    if SQL_DATA_PROVIDER_PATH in response.url:
+        try:
+            response.json()
+        except ValueError:
+            return True
+
+    return False
+
+
+def stamp_days(now, limit) -> list:
+    days = [now]
+    while days[0].date() > limit.date():
+        days.insert(0, max(days[0] - timedelta(days=1), limit))
+
+    return days
+
+
+def stamps_query(day, startrow=0, rows=STAMPS_PAGE_SIZE) -> dict:
+    return {
+        "rows": str(rows),
+        "startrow": str(startrow),
+        "count": "true",
+        "sqlcmd": "rows:ushp_fgettimbrus",
+        "pDATE": day.strftime("%Y-%m-%d"),
+    }
+
+
+def is_stamp(row) -> bool:
+    return (
+        isinstance(row, list)
+        and len(row) > 2
+        and STAMP_TIME_PATTERN.match(str(row[1])) is not None
+    )
+
+
+def rows_count(row):
+    # with count=true the row closing Data holds the rows of the whole query
+    for value in row if isinstance(row, list) else [row]:
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            continue
+
+    return None
+
+
+def parse_page(result) -> tuple:
+    if "Data" not in result:
+        raise ApiError(f"Invalid response from server: {result}")
+
+    # the closing row is dropped only when there is one, not the last stamp
+    rows = result["Data"]
+    total = None
+    if rows and not is_stamp(rows[-1]):
+        total = rows_count(rows[-1])
+        rows = rows[:-1]
+
+    return [(stamp[2], stamp[1]) for stamp in rows], total
+
+
+def last_page(page: list, fetched: int, total, page_size: int) -> bool:
+    # the count tells when the query is over without asking for an empty page
+    return len(page) < page_size or (total is not None and fetched >= total)
+
+
+def recent_stamps(day, stamps, limit) -> list:
+    recent = []
+    for stamp in stamps:
+        stamp_time = datetime.strptime(stamp[1], "%H:%M")
+        if day.replace(hour=stamp_time.hour, minute=stamp_time.minute) > limit:
+            recent.append(stamp)
+
+    return recent
+
+
+def scan_m_cid(chunks) -> str:
+    pattern = re.compile(M_CID_PATTERN.encode())
+
+    # keep the tail of the previous chunk, the token may be split across two
+    buffer = b""
+    for chunk in chunks:
+        buffer = buffer[-M_CID_OVERLAP:] + chunk
+        match = pattern.search(buffer)
+        if match:
+            return match.group(1).decode()
+
+    raise ApiError(f"Failed to find m_cID in response")
+
+
+def stamp_accepted(result) -> bool:
+    return "routine eseguita" in result
+
+
+def check_stamp_result(result) -> None:
+    if not stamp_accepted(result):
+        raise ApiError(f"Invalid response from server on stamp: {result}")
+
+
+def portal_operation(operation):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            outcome = "ok"
+            try:
+                return func(*args, **kwargs)
+            except InvalidCredentials:
+                outcome = "invalid_credentials"
+                raise
+            except PortalUnavailable:
+                outcome = "unavailable"
+                raise
+            except ApiError as e:
+                timeout = isinstance(e.__cause__, requests.Timeout)
+                outcome = "timeout" if timeout else "api_error"
+                raise
+            except Exception:
+                outcome = "error"
+                raise
+            finally:
+                PORTAL_SECONDS.labels(operation, outcome).observe(
+                    time.monotonic() - started
+                )
+
+        return wrapper
+
+    return decorator
+
+
 class ZucchettiApi:
-    def __init__(self, username, password) -> None:
+    def __init__(
+        self,
+        username,
+        password,
+        base_url=None,
+        interval=DEFAULT_INTERVAL,
+        on_login=None,
+        dedup_window=STAMP_DEDUP_WINDOW,
+        login_limiter=None,
+    ) -> None:
         self._username = username
         self._password = password
         self._session = None
+        self._m_cid = None
+        # held by logins and stamps, so a stamp never sees the session change
+        self._session_lock = threading.RLock()
+        self._flight = SingleFlight()
+        self._last_stamp = None
+        self._dedup_window = dedup_window
+        self._interval = interval
+        self._on_login = on_login
+        # spreads the first login of a restored session over time
+        self._login_limiter = login_limiter
+
+        self._base_url = base_url or os.getenv("ZUCCHETTI_BASE_URL")
+
+    def dump_state(self) -> dict:
+        session = self._session
+        cookies = [
+            (cookie.name, cookie.value, cookie.domain, cookie.path)
+            for cookie in (session.cookies if session else ())
+        ]
+
+        return {
+            "username": self._username,
+            "password": self._password,
+            "base_url": self._base_url,
+            "cookies": cookies,
+        }
 
-        self._base_url = os.getenv("ZUCCHETTI_BASE_URL")
+    @classmethod
+    def from_state(
+        cls, state: dict, on_login=None, login_limiter=None
+    ) -> "ZucchettiApi":
+        api = cls(
+            state["username"],
+            state["password"],
+            base_url=state.get("base_url"),
+            on_login=on_login,
+            login_limiter=login_limiter,
+        )
+
+        # the portal session of the previous run is reused until it expires
+        if state.get("cookies"):
+            session = new_session()
+            for name, value, domain, path in state["cookies"]:
+                session.cookies.set(name, value, domain=domain, path=path)
+            api._session = session
+
+        return api
 
     def login(self) -> None:
-        session = requests.Session()
-        session.headers["User-Agent"] = USER_AGENT
+        self._flight.do("login", self._locked_login)
+
+    def _locked_login(self) -> None:
+        with self._session_lock:
+            self._limited_login()
+
+    def _limited_login(self) -> None:
+        limiter = self._login_limiter
+        if not limiter:
+            self._login()
+            return
+
+        with limiter.slot():
+            self._login()
+        self._login_limiter = None
+
+    @portal_operation("login")
+    def _login(self) -> None:
+        session = new_session()
 
         data = {
             "m_cUserName": self._username,
             "m_cPassword": self._password,
             "m_cAction": "login",
         }
-        response = session.post(
-            self._base_url + LOGIN_PATH, data=data, timeout=REQUEST_TIMEOUT
-        )
+        response = self._send(session, "post", LOGIN_PATH, data=data)
 
         if response.status_code != 200:
             raise ApiError(f"Invalid status code: {response.status_code}")
@@ -52,48 +396,167 @@ class ZucchettiApi:
             raise InvalidCredentials()
 
         self._session = session
+        self._m_cid = None
+
+        if self._on_login:
+            self._on_login(self)
+
+    def _relogin(self, expired_session) -> None:
+        # concurrent requests that see the same expired session log in only once
+        with self._session_lock:
+            if self._session is expired_session:
+                self._limited_login()
+
+    @property
+    def breaker(self):
+        return breaker_for(self._base_url, REQUEST_TIMEOUT)
+
+    def _send(self, session, method, path, **kwargs):
+        breaker = self.breaker
+        if not breaker.allow():
+            raise PortalUnavailable(
+                f"Portal unavailable, retrying in {breaker.retry_after:.0f}s"
+            )
+
+        # a stamp that timed out may have been recorded anyway, so it is never
+        # retried and waits as long as possible
+        timeout = REQUEST_TIMEOUT if path == STAMP_PATH else breaker.timeout
+        timeouts = 0
+        while True:
+            with portal_limiter.slot():
+                started = time.monotonic()
+                try:
+                    response = session.request(
+                        method, self._base_url + path, timeout=timeout, **kwargs
+                    )
+                    break
+                except requests.Timeout as e:
+                    timeouts += 1
+                    retry = breaker.slower(timeout) if timeouts == 1 else None
+                    if retry:
+                        timeout = retry
+                        continue
+
+                    breaker.failure(timeouts)
+                    raise ApiError(f"Request to {path} failed: {e}") from e
+                except requests.RequestException as e:
+                    breaker.failure()
+                    raise ApiError(f"Request to {path} failed: {e}") from e
+
+        if response.status_code >= 500:
+            breaker.failure()
+        else:
+            breaker.success(time.monotonic() - started)
+
+        return response
+
+    def _request(self, method, path, **kwargs):
+        if not self._session:
+            self._relogin(None)
+
+        session = self._session
+        response = self._send(session, method, path, **kwargs)
+
+        if session_expired(response):
+            logger.info("Session of user %s expired, logging in again", self._username)
+
+            response.close()
+            self._relogin(session)
+            response = self._send(self._session, method, path, **kwargs)
+
+            if session_expired(response):
+                response.close()
+                raise ApiError(f"Session expired right after login on {path}")
+
+        if response.status_code != 200:
+            # a streamed response holds its connection until it is closed
+            response.close()
+            raise ApiError(f"Invalid status code: {response.status_code}")
 
-    def last_stamps(self, interval=12) -> list:
+        return response
+
+    def last_stamps(self, interval=None, max_age=None, ttl=None) -> list:
         now = datetime.now()
-        limit = now - timedelta(hours=interval)
+        limit = now - timedelta(hours=interval or self._interval)
+
+        days = stamp_days(now, limit)
+
+        missing = [day for day in days if self._cached_stamps(day, max_age) is None]
+        if len(missing) > 1 and not self._session:
+            self._relogin(None)
+
+        # the previous days are fetched in parallel with the current one
+        futures = [
+            _stamps_executor.submit(
+                run_with_priority,
+                current_priority(),
+                self._get_stamps,
+                day,
+                max_age,
+                ttl,
+            )
+            for day in days[:-1]
+        ]
+        results = [future.result() for future in futures] + [
+            self._get_stamps(days[-1], max_age, ttl)
+        ]
 
         stamps = []
+        for day, day_stamps in zip(days, results):
+            stamps += recent_stamps(day, day_stamps, limit)
 
-        def add_stamps(day):
-            for stamp in self._get_stamps(day):
-                stamp_time = datetime.strptime(stamp[1], "%H:%M")
-                if day.replace(hour=stamp_time.hour, minute=stamp_time.minute) > limit:
-                    stamps.append(stamp)
+        return stamps
 
-        if limit.day != now.day:
-            add_stamps(limit)
-        add_stamps(now)
+    def _cached_stamps(self, day, max_age=None):
+        return stamps_cache.get(stamps_key(self._username, day), max_age)
 
-        return stamps
+    def _get_stamps(self, day, max_age=None, ttl=None) -> list:
+        stamps = self._cached_stamps(day, max_age)
+        if stamps is not None:
+            return stamps
 
-    def _get_stamps(self, day) -> list:
-        data = {
-            "rows": "10",
-            "startrow": "0",
-            "count": "true",
-            "sqlcmd": "rows:ushp_fgettimbrus",
-            "pDATE": day.strftime("%Y-%m-%d"),
-        }
-        response = self._session.post(
-            self._base_url + SQL_DATA_PROVIDER_PATH, data, timeout=REQUEST_TIMEOUT
+        # the same day asked by concurrent calls is fetched once
+        return self._flight.do(
+            ("stamps", day.strftime("%Y-%m-%d")), self._load_stamps, day, ttl
         )
 
-        if response.status_code != 200:
-            raise ApiError(f"Invalid status code: {response.status_code}")
+    def _load_stamps(self, day, ttl) -> list:
+        stamps = list(self._day_stamps(day))
+        stamps_cache.put(stamps_key(self._username, day), stamps, ttl)
 
-        result = response.json()
-        if "Data" not in result:
-            raise ApiError(f"Invalid response from server: {result}")
+        return stamps
 
-        if len(result["Data"]) > 0:
-            return [(stamp[2], stamp[1]) for stamp in result["Data"][:-1]]
+    def iter_stamps(self, start, end=None, page_size=STAMPS_PAGE_SIZE):
+        # the stamps from start to end, both included, as (direction, time, date):
+        # a page of a day is fetched only when the previous one was consumed, so
+        # weeks of history are never held in memory
+        day = datetime(start.year, start.month, start.day)
+        end = end or datetime.now()
+        last = datetime(end.year, end.month, end.day)
+
+        while day <= last:
+            for direction, stamp_time in self._day_stamps(day, page_size):
+                yield direction, stamp_time, day.date()
+
+            day += timedelta(days=1)
+
+    def _day_stamps(self, day, page_size=STAMPS_PAGE_SIZE):
+        fetched = 0
+        while True:
+            page, total = self._fetch_stamps(day, fetched, page_size)
+            yield from page
+
+            fetched += len(page)
+            if last_page(page, fetched, total, page_size):
+                return
+
+    @portal_operation("stamps")
+    def _fetch_stamps(self, day, startrow=0, rows=STAMPS_PAGE_SIZE) -> tuple:
+        response = self._request(
+            "post", SQL_DATA_PROVIDER_PATH, data=stamps_query(day, startrow, rows)
+        )
 
-        return []
+        return parse_page(response.json())
 
     def enter(self):
         self._stamp("E")
@@ -101,26 +564,56 @@ class ZucchettiApi:
     def exit(self):
         self._stamp("U")
 
+    @portal_operation("m_cid")
+    def _fetch_m_cid(self) -> str:
+        # the token is near the top of a heavy page, stop reading once found
+        response = self._request("get", M_CID_PATH, stream=True)
+        try:
+            m_cID = scan_m_cid(response.iter_content(chunk_size=M_CID_CHUNK_SIZE))
+        except requests.RequestException as e:
+            # the body is read after the request returned, a broken one is a
+            # failure of the portal as well
+            self.breaker.failure()
+            raise ApiError(f"Failed to read {M_CID_PATH}: {e}") from e
+        finally:
+            response.close()
+
+        self._m_cid = m_cID
+        return m_cID
+
     def _stamp(self, direction):
-        response = self._session.get(
-            self._base_url + M_CID_PATH, timeout=REQUEST_TIMEOUT
-        )
-        if response.status_code != 200:
-            raise ApiError(f"Invalid status code: {response.status_code}")
+        # the stamps of a user are sent one at a time
+        with self._session_lock:
+            # a double send or a retried tap is the stamp that was just done
+            if self._last_stamp and self._last_stamp[0] == direction:
+                if time.monotonic() - self._last_stamp[1] < self._dedup_window:
+                    logger.info(
+                        "Duplicate stamp %s of user %s ignored",
+                        direction,
+                        self._username,
+                    )
+                    return
+
+            self._locked_stamp(direction)
+            self._last_stamp = (direction, time.monotonic())
+
+    @portal_operation("stamp")
+    def _locked_stamp(self, direction):
+        cached = self._m_cid is not None
+        m_cID = self._m_cid or self._fetch_m_cid()
 
-        match = re.search("this.splinker10.m_cID='(.+?)';", response.text)
-        if not match:
-            raise ApiError(f"Failed to find m_cID in response")
+        data = {"verso": direction, "causale": "", "m_cID": m_cID}
+        response = self._request("post", STAMP_PATH, data=data)
 
-        m_cID = match.group(1)
+        if cached and not stamp_accepted(response.text):
+            logger.info("Cached m_cID of user %s rejected, refreshing", self._username)
 
-        data = {"verso": direction, "causale": "", "m_cID": m_cID}
-        response = self._session.post(
-            self._base_url + STAMP_PATH, data, timeout=REQUEST_TIMEOUT
-        )
-        if response.status_code != 200:
-            raise ApiError(f"Invalid status code: {response.status_code}")
+            data["m_cID"] = self._fetch_m_cid()
+            response = self._request("post", STAMP_PATH, data=data)
 
-        result = response.text
-        if "routine eseguita" not in result:
-            raise ApiError(f"Invalid response from server on stamp: {result}")
+        check_stamp_result(response.text)
+
+        now = datetime.now()
+        stamps_cache.append(
+            stamps_key(self._username, now), (direction, now.strftime("%H:%M"))
+        )